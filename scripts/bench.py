@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк индексатора и поиска без реального API.
+
+Поднимает локальный HTTP-сервер, который отвечает как OpenAI (embeddings и
+chat completions) с заданной задержкой и лимитом запросов в минуту, генерирует
+синтетические ЖЖ-посты, стихи и Telegram-посты и в песочнице (свои REPO_ROOT
+и HOME) меряет:
+    — индексацию indexer.py --source all: время, документов и чанков в
+      секунду, пиковый RSS, метрики стадий из index_metrics.json;
+    — повторный прогон без изменений;
+    — поиск mcp_search.search_corpus: первый запрос и p50/p95/p99.
+
+Использование:
+    python scripts/bench.py                               # 1k документов
+    python scripts/bench.py --sizes 1000 10000 100000
+    python scripts/bench.py --latency 300 --rpm 3000      # ближе к реальному API
+    python scripts/bench.py --indexer-args "--tpm 0"      # без лимита токенов индексатора
+    python scripts/bench.py --serve --port 8765           # только фейковый сервер
+
+Результаты дописываются строками JSON (одна на размер корпуса) в
+~/.config/clody_spark/bench.jsonl — их удобно сравнивать между версиями.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import base64
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from array import array
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from embedders import HashEmbedder, NATIVE_DIMENSIONS
+
+BENCH_FILE  = Path.home() / ".config/clody_spark/bench.jsonl"
+SCRIPTS_DIR = Path(__file__).parent
+REPO_ROOT   = SCRIPTS_DIR.parent
+SANDBOX_SCRIPTS = ("indexer.py", "embedders.py", "lexical.py", "filters.py", "layout.py", "mcp_search.py",
+                   "bench.py")   # bench.py — для --search-worker: он импортирует mcp_search песочницы
+
+# Доли источников в синтетическом корпусе
+SHARES = {"lj": 0.5, "poetry": 0.3, "telegram": 0.2}
+
+WORDS = (
+    "мир тень свет память голос река слово дом ночь город утро снег окно дорога "
+    "море ветер книга письмо сад время сон песня берег поле небо огонь зима весна "
+    "лето осень тишина музыка дочь отец мать друг имя порог дверь мост зеркало "
+    "стекло камень лес птица звезда луна дождь туман вокзал поезд улица комната "
+    "ключ нить узел граница язык смысл вопрос ответ начало конец путь шаг"
+).split()
+
+SEARCH_QUERIES = 200
+
+
+# ── Фейковый OpenAI ───────────────────────────────────────────────────────────
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """
+    /v1/embeddings и /v1/chat/completions. Векторы — HashEmbedder (лексическое
+    сходство, так что поиск осмысленный), аннотации — начало текста.
+    Задержка: latency + per_item × число входов. При превышении rpm отвечает
+    429 с retry-after-ms и x-ratelimit-* — как настоящий API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.05, per_item: float = 0.0, rpm: int = 0):
+        super().__init__(("127.0.0.1", port), FakeHandler)
+        self.latency   = latency
+        self.per_item  = per_item
+        self.rpm       = rpm
+        self.window    = deque()   # время запросов за последнюю минуту
+        self.lock      = threading.Lock()
+        self.embedders: dict[int, HashEmbedder] = {}
+        self.calls     = {"embeddings": 0, "chat": 0, "rate_limited": 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def admit(self) -> float:
+        """0 — запрос принят, иначе через сколько секунд освободится окно."""
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            if self.rpm and len(self.window) >= self.rpm:
+                self.calls["rate_limited"] += 1
+                return 60 - (now - self.window[0])
+            self.window.append(now)
+            return 0.0
+
+    def remaining(self) -> int:
+        with self.lock:
+            return max(0, self.rpm - len(self.window)) if self.rpm else 1_000_000
+
+    def embeddings(self, body: dict) -> tuple[dict, int]:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dims  = body.get("dimensions") or NATIVE_DIMENSIONS.get(body["model"], 3072)
+        with self.lock:
+            self.calls["embeddings"] += 1
+            embedder = self.embedders.setdefault(dims, HashEmbedder(dims))
+        vectors = embedder.embed(texts)
+        if body.get("encoding_format") == "base64":
+            vectors = [base64.b64encode(array("f", v).tobytes()).decode() for v in vectors]
+        tokens = sum(len(t) // 3 + 1 for t in texts)
+        return {
+            "object": "list",
+            "model":  body["model"],
+            "data":   [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+            "usage":  {"prompt_tokens": tokens, "total_tokens": tokens},
+        }, len(texts)
+
+    def chat(self, body: dict) -> tuple[dict, int]:
+        with self.lock:
+            self.calls["chat"] += 1
+        prompt  = " ".join(m["content"] for m in body["messages"])
+        words   = body["messages"][-1]["content"].split()
+        content = " ".join(words[:40])
+        return {
+            "id":      "chatcmpl-bench",
+            "object":  "chat.completion",
+            "created": int(time.time()),
+            "model":   body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage":   {"prompt_tokens": len(prompt) // 3 + 1, "completion_tokens": len(content) // 3 + 1,
+                        "total_tokens": (len(prompt) + len(content)) // 3 + 2},
+        }, 1
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, payload: dict, headers: dict | None = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        body   = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        wait   = server.admit()
+        if wait:
+            self.reply(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                       "code": "rate_limit_exceeded"}}, {
+                "retry-after-ms":                 str(int(wait * 1000)),
+                "x-ratelimit-limit-requests":     str(server.rpm),
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests":     f"{wait:.3f}s",
+            })
+            return
+        if self.path.endswith("/embeddings"):
+            payload, n = server.embeddings(body)
+        elif self.path.endswith("/chat/completions"):
+            payload, n = server.chat(body)
+        else:
+            self.reply(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        time.sleep(server.latency + server.per_item * n)
+        self.reply(200, payload, {
+            "x-ratelimit-limit-requests":     str(server.rpm or 1_000_000),
+            "x-ratelimit-remaining-requests": str(server.remaining()),
+        })
+
+
+# ── Синтетический корпус ──────────────────────────────────────────────────────
+
+def paragraph(rng: random.Random, lo: int, hi: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi))).capitalize() + "."
+
+
+def write_lj(root: Path, rng: random.Random, n: int):
+    for i in range(n):
+        year, month, day = 2003 + i % 20, 1 + i // 20 % 12, 1 + i % 28
+        body = "\n\n".join(paragraph(rng, 10, 260) for _ in range(rng.randint(1, 8)))
+        path = root / f"lj/{year}/{month:02d}/{year}-{month:02d}-{day:02d}-{i}.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(
+            f"# Пост {i}\n\n**Дата:** {year}-{month:02d}-{day:02d} 12:00:00\n"
+            f"**Теги:** {rng.choice(WORDS)}, {rng.choice(WORDS)}\n\n---\n\n{body}\n",
+            encoding="utf-8",
+        )
+
+
+def write_poetry(root: Path, rng: random.Random, n: int):
+    for i in range(n):
+        stanzas = "\n\n".join(
+            "\n".join(paragraph(rng, 3, 7) for _ in range(4)) for _ in range(rng.randint(1, 6))
+        )
+        path = root / f"poetry/poet{i % 50}/poem_{i}.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# Стихотворение {i}\n\nАвтор: Поэт {i % 50}\n\n{stanzas}\n", encoding="utf-8")
+
+
+def write_telegram(root: Path, rng: random.Random, n: int):
+    for i in range(n):
+        year, month = 2020 + i % 6, 1 + i // 6 % 12
+        body = "\n\n".join(paragraph(rng, 5, 80) for _ in range(rng.randint(1, 4)))
+        path = root / f"telegram/{year}/{month:02d}/{i}.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# Заметка {i}\n\n**Дата:** {year}-{month:02d}-01\n\n---\n\n{body}\n",
+                        encoding="utf-8")
+
+
+def write_corpus_annotations(root: Path, rng: random.Random, n: int = 50):
+    entries = [f"**bench-{i}** — *Запись {i}*\n{paragraph(rng, 20, 60)}\n" for i in range(n)]
+    (root / "corpus-annotations.md").write_text("## Бенчмарк\n\n" + "\n".join(entries), encoding="utf-8")
+
+
+def make_sandbox(root: Path, size: int, seed: int = 0) -> dict:
+    """Копия скриптов, синтетический корпус и HOME с ключом. Возвращает {источник: документов}."""
+    (root / "scripts").mkdir(parents=True)
+    for name in SANDBOX_SCRIPTS:
+        shutil.copy2(SCRIPTS_DIR / name, root / "scripts" / name)
+    config = root / "home/.config/clody_spark"
+    config.mkdir(parents=True)
+    (config / "openai.json").write_text(json.dumps({"api_key": "bench"}), encoding="utf-8")
+
+    rng    = random.Random(seed)
+    counts = {name: int(size * share) for name, share in SHARES.items()}
+    write_lj(root, rng, counts["lj"])
+    write_poetry(root, rng, counts["poetry"])
+    write_telegram(root, rng, counts["telegram"])
+    write_corpus_annotations(root, rng)
+    return counts
+
+
+# ── Замеры ────────────────────────────────────────────────────────────────────
+
+def run_measured(cmd: list[str], env: dict) -> dict:
+    """Запускает процесс, возвращает время, пиковый RSS и код выхода."""
+    with tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc  = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=err)
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            err.seek(0)
+            raise RuntimeError(f"{' '.join(cmd[1:])} завершился с кодом {proc.returncode}:\n"
+                               + err.read().decode("utf-8", "replace")[-2000:])
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    rss = usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    return {"seconds": round(elapsed, 3), "peak_rss_mb": round(rss, 1)}
+
+
+def percentile_ms(values: list[float]) -> dict:
+    q = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return {
+        "p50_ms": round(q[49] * 1000, 2),
+        "p95_ms": round(q[94] * 1000, 2),
+        "p99_ms": round(q[98] * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+def search_worker(queries: int):
+    """Запускается в песочнице: замер search_corpus, латентности — JSON в stdout."""
+    import mcp_search
+
+    rng       = random.Random(1)
+    latencies = []
+    for _ in range(queries + 1):
+        query = " ".join(rng.sample(WORDS, 3))
+        start = time.perf_counter()
+        mcp_search.search_corpus(query, n=5)
+        latencies.append(time.perf_counter() - start)
+    print(json.dumps(latencies))
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "-C", str(REPO_ROOT), "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_size(size: int, server: FakeOpenAI, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="clody_bench_") as tmp:
+        root   = Path(tmp)
+        counts = make_sandbox(root, size)
+        env    = {
+            **os.environ,
+            "HOME":            str(root / "home"),
+            "OPENAI_BASE_URL": server.base_url,
+            "PYTHONPATH":      str(root / "scripts"),
+        }
+        indexer = [sys.executable, str(root / "scripts/indexer.py"), "--source", "all",
+                   "--workers", str(args.workers), "--dimensions", str(args.dimensions), "--no-cache",
+                   *shlex.split(args.indexer_args)]
+
+        calls_before = dict(server.calls)
+        index   = run_measured(indexer, env)
+        metrics = json.loads((root / "home/.config/clody_spark/index_metrics.json").read_text("utf-8"))
+        calls   = {k: server.calls[k] - calls_before[k] for k in server.calls}
+        noop    = run_measured(indexer, env)
+
+        if args.dimensions:
+            env["CLODY_EMBED_DIMENSIONS"] = str(args.dimensions)
+        out = subprocess.run(
+            [sys.executable, str(root / "scripts/bench.py"), "--search-worker", str(args.queries)],
+            env=env, cwd=root, capture_output=True, text=True, check=True,
+        )
+        latencies = json.loads(out.stdout)
+
+    chunks = metrics["counters"].get("chunks", 0)
+    docs   = metrics["counters"].get("docs", 0)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git":       git_revision(),
+        "python":    sys.version.split()[0],
+        "size":      size,
+        "sources":   counts,
+        "server":    {"latency_ms": args.latency, "per_item_ms": args.per_item, "rpm": args.rpm},
+        "options":   {"workers": args.workers, "dimensions": args.dimensions,
+                      "indexer_args": args.indexer_args},
+        "index":     {
+            **index,
+            "docs":          docs,
+            "chunks":        chunks,
+            "docs_per_s":    round(docs / index["seconds"], 1),
+            "chunks_per_s":  round(chunks / index["seconds"], 1),
+            "api_calls":     calls,
+            "metrics":       {k: metrics[k] for k in ("counters", "timings")},
+        },
+        "reindex_noop": noop,
+        "search":    {"queries": len(latencies) - 1, "cold_ms": round(latencies[0] * 1000, 2),
+                      **percentile_ms(latencies[1:])},
+    }
+
+
+def print_result(r: dict):
+    i, s = r["index"], r["search"]
+    print(f"{r['size']:>7} док.: индексация {i['seconds']:.1f} с ({i['docs_per_s']} док/с, "
+          f"{i['chunks_per_s']} чанков/с, RSS {i['peak_rss_mb']} МБ), "
+          f"повторно {r['reindex_noop']['seconds']:.1f} с, "
+          f"поиск p50 {s['p50_ms']} / p95 {s['p95_ms']} / p99 {s['p99_ms']} мс")
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000],
+                        help="Размеры синтетического корпуса, документов")
+    parser.add_argument("--latency", type=float, default=50,
+                        help="Задержка фейкового API на запрос, мс")
+    parser.add_argument("--per-item", type=float, default=0.0,
+                        help="Добавка к задержке на каждый вход запроса, мс")
+    parser.add_argument("--rpm", type=int, default=0,
+                        help="Лимит запросов в минуту фейкового API (0 = без лимита)")
+    parser.add_argument("--workers", type=int, default=4, help="--workers индексатора")
+    parser.add_argument("--dimensions", type=int, default=0, help="--dimensions индексатора")
+    parser.add_argument("--indexer-args", default="",
+                        help='Доп. аргументы indexer.py, например "--rpm 0 --tpm 0"')
+    parser.add_argument("--queries", type=int, default=SEARCH_QUERIES, help="Поисковых запросов")
+    parser.add_argument("--out", type=Path, default=BENCH_FILE, help="Куда дописывать результаты (JSON lines)")
+    parser.add_argument("--serve", action="store_true", help="Только поднять фейковый API и ждать")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--search-worker", type=int, metavar="N", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.search_worker is not None:
+        search_worker(args.search_worker)
+        sys.exit(0)
+
+    server = FakeOpenAI(args.port, args.latency / 1000, args.per_item / 1000, args.rpm)
+    if args.serve:
+        print(f"Фейковый OpenAI: OPENAI_BASE_URL={server.base_url}  (Ctrl+C — выход)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    for size in args.sizes:
+        result = bench_size(size, server, args)
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print_result(result)
+    server.shutdown()
+    print(f"Результаты: {args.out}")
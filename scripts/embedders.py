@@ -0,0 +1,180 @@
+"""
+Эмбеддеры для indexer.py и mcp_search.py — общий интерфейс над разными
+бэкендами. Бэкенд задаётся строкой «backend:model»:
+
+    openai:text-embedding-3-large            # по умолчанию, сеть
+    local:intfloat/multilingual-e5-small     # CPU, sentence-transformers
+    hash                                     # детерминированный, без модели (тесты)
+
+Строка записывается в метаданные коллекции; у каждого эмбеддера своя
+коллекция (см. collection_name), векторы разных моделей не смешиваются.
+"""
+
+import re
+import sys
+import math
+import hashlib
+import importlib.util
+
+DEFAULT_EMBEDDER  = "openai:text-embedding-3-large"
+NATIVE_DIMENSIONS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536}
+HASH_DIMENSIONS   = 256
+
+
+class Embedder:
+    """
+    spec       — строка «backend:model», как в конфиге;
+    model      — ключ модели для кэша эмбеддингов;
+    dimensions — размерность выдаваемых векторов.
+    embed(texts, query=False) — query=True для поисковых запросов
+    (асимметричным моделям вроде e5 нужен свой префикс).
+    """
+
+    backend    = ""
+    spec       = ""
+    model      = ""
+    dimensions = 0
+    cacheable  = True   # имеет ли смысл дисковый кэш (для hash — нет)
+
+    def embed(self, texts: list[str], query: bool = False) -> list[list[float]]:
+        raise NotImplementedError
+
+    def cache_key(self, query: bool = False) -> str:
+        """Ключ модели в кэше эмбеддингов; запросы и документы совпадают."""
+        return self.model
+
+
+class OpenAIEmbedder(Embedder):
+    backend = "openai"
+
+    def __init__(self, client_factory, model: str = "text-embedding-3-large", dimensions: int = 0):
+        self.client_factory = client_factory   # клиент создаётся при первом запросе
+        self._client        = None
+        self.spec           = f"openai:{model}"
+        self.model          = model
+        self.requested      = dimensions       # 0 — не передаём параметр
+        self.dimensions     = dimensions or NATIVE_DIMENSIONS.get(model, 0)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    def embed(self, texts: list[str], query: bool = False) -> list[list[float]]:
+        extra    = {"dimensions": self.requested} if self.requested else {}
+        response = self.client.embeddings.create(model=self.model, input=texts, **extra)
+        return [item.embedding for item in response.data]
+
+
+class LocalEmbedder(Embedder):
+    """
+    Модель sentence-transformers на CPU. Если установлен optimum[onnxruntime]
+    (и sentence-transformers ≥ 3.2), модель запускается через ONNX Runtime,
+    иначе — или если ONNX-загрузка не удалась — через torch; какой выбран,
+    видно в runtime. Векторы обоих путей совпадают до погрешности float,
+    ключ кэша у них общий. Модель грузится один раз на процесс.
+    """
+
+    backend = "local"
+
+    def __init__(self, model: str = "intfloat/multilingual-e5-small", dimensions: int = 0):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError(
+                "Для local-эмбеддера нужен пакет sentence-transformers: "
+                "pip install sentence-transformers"
+            ) from e
+        self.spec    = f"local:{model}"
+        self.model   = self.spec
+        self.st      = None
+        self.runtime = "torch"
+        options      = dict(device="cpu", truncate_dim=dimensions or None)
+        if importlib.util.find_spec("optimum") is not None:
+            try:
+                self.st      = SentenceTransformer(model, backend="onnx", **options)
+                self.runtime = "onnx"
+            except Exception as e:   # старый sentence-transformers, нет onnxruntime, экспорт не удался
+                print(f"ONNX-бэкенд недоступен ({type(e).__name__}: {e}), модель на torch",
+                      file=sys.stderr)
+        if self.st is None:
+            self.st = SentenceTransformer(model, **options)
+        self.dimensions = self.st.get_sentence_embedding_dimension()
+        # e5: «query: » / «passage: » — без них качество заметно падает
+        self.prefixes   = ("query: ", "passage: ") if "e5" in model.lower() else ("", "")
+
+    def embed(self, texts: list[str], query: bool = False) -> list[list[float]]:
+        prefix  = self.prefixes[0] if query else self.prefixes[1]
+        vectors = self.st.encode(
+            [prefix + t for t in texts], batch_size=32, normalize_embeddings=True,
+        )
+        return vectors.tolist()
+
+    def cache_key(self, query: bool = False) -> str:
+        # с префиксами вектор запроса отличается от вектора того же текста-документа
+        return self.model + ("|query" if query and self.prefixes[0] else "")
+
+
+class HashEmbedder(Embedder):
+    """
+    Детерминированный эмбеддер без модели: слова и их символьные триграммы
+    хэшируются в вектор фиксированной длины (feature hashing). Ловит только
+    лексическое сходство — для тестов и офлайн-отладки конвейера.
+    """
+
+    backend   = "hash"
+    cacheable = False
+
+    def __init__(self, dimensions: int = 0):
+        self.dimensions = dimensions or HASH_DIMENSIONS
+        self.spec       = "hash"
+        self.model      = f"hash-{self.dimensions}"
+
+    def features(self, text: str):
+        for word in re.findall(r"\w+", text.lower()):
+            yield word
+            padded = f"^{word}$"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def embed(self, texts: list[str], query: bool = False) -> list[list[float]]:
+        vectors = []
+        for text in texts:
+            vec = [0.0] * self.dimensions
+            for feature in self.features(text):
+                h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+                vec[h % self.dimensions] += 1.0 if h >> 63 else -1.0
+            norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+            vectors.append([x / norm for x in vec])
+        return vectors
+
+
+def make_embedder(spec: str, dimensions: int = 0, client_factory=None) -> Embedder:
+    """
+    spec — «backend:model». client_factory() создаёт клиент OpenAI;
+    вызывается только openai-бэкендом и только при первом запросе.
+    """
+    backend, _, model = spec.partition(":")
+    if backend == "openai":
+        return OpenAIEmbedder(client_factory, model or "text-embedding-3-large", dimensions)
+    if backend == "local":
+        return LocalEmbedder(model or "intfloat/multilingual-e5-small", dimensions)
+    if backend == "hash":
+        return HashEmbedder(dimensions)
+    raise ValueError(f"Неизвестный эмбеддер: {spec}")
+
+
+def collection_name(base: str, spec: str, dimensions: int = 0) -> str:
+    """
+    Имя коллекции под эмбеддер. Для openai по умолчанию — просто base
+    (совместимость с уже построенным индексом), иначе base_<backend>_<model>.
+    Уменьшенная размерность добавляет _dN.
+    """
+    if spec == DEFAULT_EMBEDDER:
+        name = base
+    else:
+        backend, _, model = spec.partition(":")
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", model).strip("-")
+        name = f"{base}_{backend}" + (f"_{slug}" if slug else "")
+    return f"{name}_d{dimensions}" if dimensions else name
@@ -0,0 +1,119 @@
+"""
+Фильтры поиска для indexer.py и mcp_search.py: числовые поля дат и тегов
+в метаданных чанков и сборка where для Chroma из параметров запроса.
+
+В метаданных, кроме исходных строк date и tags:
+    year     — год (int)
+    day      — дней от 1970-01-01 (int), по нему фильтр date_from / date_to
+    tag_list — теги списком, в нижнем регистре, для $contains
+
+Дата берётся из date, у стихов — из year_text (строка «Год:» как есть:
+«Март 1902», «28 декабря 1903», «⟨1829⟩, начало 1830-х годов»). Неполная
+дата ложится на начало периода: «Март 1902» — 1 марта, «1913» — 1 января.
+Если года в строке нет («Конец октября»), year и day не пишутся, и любой
+фильтр по датам такой чанк отбрасывает; без фильтра он находится как обычно.
+
+Границы периода задаются так же свободно, как даты в источниках:
+«2008», «2008-05», «2008-05-17». date_to включает период целиком:
+«2010» — по 31 декабря 2010.
+"""
+
+import re
+import calendar
+from datetime import date
+
+FILTERS_VERSION = 2   # в манифесте: записи без него indexer.py дозаполняет
+
+EPOCH     = date(1970, 1, 1).toordinal()
+ISO_RE    = re.compile(r"(\d{4})(?:[-./](\d{1,2})(?:[-./](\d{1,2}))?)?")
+DOTTED_RE = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})")
+MONTHS    = ("янв", "фев", "мар", "апр", "ма", "июн", "июл", "авг", "сен", "окт", "ноя", "дек")
+RU_RE     = re.compile(r"(?:(\d{1,2})\s+)?(янв|фев|мар|апр|ма[йяе]|июн|июл|авг|сен|окт|ноя|дек)"
+                       r"[а-я]*\.?\s+(\d{4})", re.IGNORECASE)
+
+
+def parse_date(text: str, end: bool = False) -> date | None:
+    """
+    Первая дата в строке: «2005-01-05 12:00:00», «2005-01», «2005»,
+    «05.01.2005», «28 декабря 1903», «Март 1902». Неполная дата — начало
+    периода, с end=True — его конец.
+    """
+    m  = DOTTED_RE.search(text or "")
+    ru = RU_RE.search(text or "")
+    if m:
+        year, month, day = int(m.group(3)), int(m.group(2)), int(m.group(1))
+    elif ru:
+        month = next(i for i, p in enumerate(MONTHS, 1) if ru.group(2).lower().startswith(p))
+        year  = int(ru.group(3))
+        day   = int(ru.group(1)) if ru.group(1) else None
+    else:
+        m = ISO_RE.search(text or "")
+        if not m:
+            return None
+        year  = int(m.group(1))
+        month = int(m.group(2)) if m.group(2) else (12 if end else 1)
+        day   = int(m.group(3)) if m.group(3) else None
+    if not (1 <= month <= 12 and 1 <= year <= 9999):   # «0000» — не дата, date() её не примет
+        return None
+    last = calendar.monthrange(year, month)[1]
+    if day is None or not 1 <= day <= last:
+        day = last if end else 1
+    return date(year, month, day)
+
+
+def epoch_day(d: date) -> int:
+    return d.toordinal() - EPOCH
+
+
+def split_tags(tags) -> list[str]:
+    """«Философия, стихи» или список → ["философия", "стихи"]."""
+    parts = tags if isinstance(tags, list) else re.split(r"[,;]", tags or "")
+    return [t.strip().lower() for t in parts if t and t.strip()]
+
+
+def filter_fields(meta: dict) -> dict:
+    """Числовые поля для where — дописываются к метаданным чанка."""
+    fields = {}
+    text   = meta.get("date") or meta.get("year_text") or ""
+    if isinstance(meta.get("year"), str):
+        # стихи до FILTERS_VERSION 2 хранили «Год:» строкой в year: переносим
+        # в year_text, а year либо станет числом ниже, либо удаляется (None)
+        fields["year_text"] = meta["year"]
+        fields["year"]      = None
+        text = text or meta["year"]
+    d = parse_date(text)
+    if d is not None:
+        fields["year"] = d.year
+        fields["day"]  = epoch_day(d)
+    tags = split_tags(meta.get("tags", ""))
+    if tags:   # пустой список Chroma не принимает
+        fields["tag_list"] = tags
+    return fields
+
+
+def build_where(source: str | None = None, date_from: str | None = None,
+                date_to: str | None = None, author: str | None = None,
+                tags=None) -> dict | None:
+    """
+    where для collection.query / get. Условия объединяются через $and;
+    tags — хотя бы один из перечисленных; author — точное совпадение.
+    """
+    clauses = []
+    if source:
+        clauses.append({"source": source})
+    for value, op, end in ((date_from, "$gte", False), (date_to, "$lte", True)):
+        if not value:
+            continue
+        d = parse_date(str(value), end=end)
+        if d is None:
+            raise ValueError(f"Не разобрать дату: {value!r} (ожидается ГГГГ, ГГГГ-ММ или ГГГГ-ММ-ДД)")
+        clauses.append({"day": {op: epoch_day(d)}})
+    if author:
+        clauses.append({"author": author})
+    tag_list = split_tags(tags)
+    if tag_list:
+        any_tag = [{"tag_list": {"$contains": t}} for t in tag_list]
+        clauses.append(any_tag[0] if len(any_tag) == 1 else {"$or": any_tag})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
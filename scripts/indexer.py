@@ -1,171 +1,1441 @@
 #!/usr/bin/env python3
 """
 Индексатор корпуса Клоди Спарк.
-Поддерживает corpus-annotations.md и ЖЖ-посты (lj/).
-
-Стратегия чанкинга:
-    < SHORT    символов → embed напрямую (full_text)
-    >= SHORT   символов → разбить на абзацы, каждый абзац:
-                              < SHORT  → embed напрямую
-                              >= SHORT → аннотация через GPT-4o-mini → embed
+Поддерживает corpus-annotations.md, ЖЖ-посты (lj/), стихи (poetry/),
+Telegram-посты (telegram/), дневники (journal/, daughter/journal/) и эссе
+(texts/) — см. SOURCES.
+
+Стратегия чанкинга (в токенах, см. count_tokens):
+    <= CHUNK_TOKENS → embed напрямую (full_text)
+    >  CHUNK_TOKENS → разбить на абзацы (строфы) и упаковать подряд идущие
+                      в чанки до CHUNK_TOKENS (с перекрытием CHUNK_OVERLAP);
+                      абзац длиннее CHUNK_TOKENS → аннотация через GPT-4o-mini → embed
+
+Аннотации считаются в пуле потоков (--workers) под общим лимитом
+запросов и токенов в минуту (--rpm, --tpm); порядок чанков сохраняется.
+Все запросы к API идут через call_api: token bucket'ы, уточняемые по
+заголовкам x-ratelimit-*, и повторы 429/таймаутов/5xx с джиттером;
+отвергнутый как слишком большой батч эмбеддингов делится пополам.
 
 Использование:
     python scripts/indexer.py                        # корпус
     python scripts/indexer.py --source lj            # ЖЖ-посты
     python scripts/indexer.py --source lj --limit 50 # первые 50 постов (тест)
+    python scripts/indexer.py --source all           # все источники за один прогон
+    python scripts/indexer.py --source lj --plan     # оценка: вызовы, токены, $, время — без API
+    python scripts/indexer.py --watch                # следить за файлами и индексировать правки
     python scripts/indexer.py --stats
+    python scripts/indexer.py --gc                   # удалить осиротевшие чанки
+    python scripts/indexer.py --recall               # recall при 256…1536 измерениях
+    python scripts/indexer.py --source all --dimensions 1024   # коллекция clody_spark_d1024
+    python scripts/indexer.py --source all --embedder local:intfloat/multilingual-e5-small  # CPU, офлайн
     python scripts/indexer.py --search "запрос"
+    python scripts/indexer.py --search "запрос" --source lj --date-from 2008 --date-to 2010 --tags философия
+    python scripts/indexer.py --annotation-cache list   # версии промпта в кэше аннотаций
+    python scripts/indexer.py --annotation-cache prune  # удалить аннотации старых промптов
+
+Инкрементальность: манифест (~/.config/clody_spark/index_manifest.json) хранит
+для каждого файла sha256, mtime, размер, id чанков и стратегию. Неизменённые
+файлы проверяются только через stat(), изменённые — перечанкиваются, а их
+старые чанки заменяются новыми.
+
+Кэши (~/.config/clody_spark/): embed_cache.sqlite — векторы по
+(модель, размерность, sha256 текста), annotation_cache.sqlite — аннотации по
+(промпт, модель, температура, контекст, текст). Отключаются --no-cache.
+
+Рядом с коллекцией ведётся лексический индекс BM25 (lexical/<коллекция>.sqlite,
+см. lexical.py) — по тем же чанкам, с полным текстом абзацев-аннотаций.
+Его читает гибридный поиск mcp_search.py.
+
+К метаданным чанков дописываются year, day (дней от 1970-01-01) и tag_list
+(см. filters.py) — фильтры по датам и тегам уходят в where Chroma. У стихов
+дата берётся из строки «Год:», которая сама хранится в year_text. Чанки,
+записанные раньше, дозаполняются при следующем прогоне без эмбеддингов.
+
+Метрики прогона (время стадий, задержки API, токены, чанков в секунду)
+пишутся в ~/.config/clody_spark/index_metrics.json, с --prometheus FILE —
+ещё и в Prometheus text format.
 """
 
+import os
 import json
+import hashlib
 import re
 import sys
+import math
+import time
+import random
+import struct
+import sqlite3
+import statistics
+import queue
 import argparse
+import threading
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import chromadb
+import openai
 from openai import OpenAI
 
-# ── Константы ─────────────────────────────────────────────────────────────────
+from embedders import DEFAULT_EMBEDDER, Embedder, make_embedder
+from lexical import LexicalIndex
+from filters import FILTERS_VERSION
+from layout import (
+    CONFIG_FILE, CHROMA_DIR, REPO_ROOT, MANIFEST_COLLECTION, SOURCE_TITLES,
+    load_api_key, collection_dimensions, read_manifest,
+)
+import layout
+import filters
+import lexical
+
+try:
+    import tiktoken
+except ImportError:    # без него — калиброванная оценка, см. estimate_tokens
+    tiktoken = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:    # без него --watch опрашивает файлы, см. PollWatcher
+    INotify = None
 
-CONFIG_FILE     = Path.home() / ".config/clody_spark/openai.json"
-CHROMA_DIR      = Path.home() / ".config/clody_spark/chroma"
-REPO_ROOT       = Path(__file__).parent.parent
-CORPUS_FILE     = REPO_ROOT / "corpus-annotations.md"
-LJ_DIR          = REPO_ROOT / "lj"
-POETRY_DIR      = REPO_ROOT / "poetry"
-TELEGRAM_DIR    = REPO_ROOT / "telegram"
-COLLECTION_NAME = "clody_spark"
+# ── Константы ─────────────────────────────────────────────────────────────────
 
-SHORT = 600   # символов — порог: короткий текст кладём как есть
+EMBED_CACHE_FILE      = Path.home() / ".config/clody_spark/embed_cache.sqlite"
+ANNOTATION_CACHE_FILE = Path.home() / ".config/clody_spark/annotation_cache.sqlite"
+METRICS_FILE          = Path.home() / ".config/clody_spark/index_metrics.json"
+CORPUS_FILE           = REPO_ROOT / "corpus-annotations.md"
+LJ_DIR                = REPO_ROOT / "lj"
+POETRY_DIR            = REPO_ROOT / "poetry"
+TELEGRAM_DIR          = REPO_ROOT / "telegram"
+JOURNAL_DIR           = REPO_ROOT / "journal"
+DAUGHTER_JOURNAL_DIR  = REPO_ROOT / "daughter/journal"
+TEXTS_DIR             = REPO_ROOT / "texts"
+
+EMBEDDER_SPEC     = DEFAULT_EMBEDDER   # «backend:model», см. embedders.py и --embedder
+EMBED_DIMENSIONS  = 0           # 0 — родная размерность модели; иначе своя коллекция
+EMBED_CACHE_MAX   = 1_000_000   # векторов в кэше; сверх — вытесняем давно не читанные
+EMBED_CACHE_DTYPE = "f"         # "f" — float32, "e" — float16 (--compact)
+
+CHUNK_TOKENS  = 300   # токенов — бюджет чанка; длиннее — абзац аннотируется
+CHUNK_OVERLAP = 0     # токенов — хвост предыдущего чанка в начале следующего
+TOKENIZER     = "cl100k_base"   # токенизатор text-embedding-3-*
+
+ID_PAGE         = 5000   # id из коллекции читаем страницами, а не одним get()
+GC_BATCH        = 1000   # id на один вызов collection.delete при --gc
+GC_DRY_RUN_SHOW = 20     # id на источник в выводе --gc --dry-run
+
+# Батч эмбеддингов собирается из чанков нескольких документов.
+# Лимиты API: 2048 входов и ~300k токенов на запрос.
+EMBED_BATCH_ITEMS  = 256
+EMBED_BATCH_TOKENS = 100_000
+
+# Конвейер индексации: разбор → аннотации → эмбеддинги → запись в Chroma.
+# Стадии — отдельные потоки с ограниченными очередями (backpressure).
+EMBED_QUEUE = 4      # батчей, ожидающих эмбеддинга
+WRITE_QUEUE = 4      # батчей, ожидающих записи
+WRITE_BATCH = 2048   # чанков на один upsert
+
+ANNOTATE_MODEL       = "gpt-4o-mini"
+ANNOTATE_TEMPERATURE = 0.3
+ANNOTATE_MAX_TOKENS  = 200
+ANNOTATE_SYSTEM      = (
+    "Ты помогаешь индексировать тексты из дневника. "
+    "Напиши очень краткую аннотацию (2–4 предложения) для семантического поиска: "
+    "о чём текст, какие ключевые идеи, настроение. Без вступлений."
+)
+
+# Аннотации GPT-4o-mini идут параллельно, но под общим лимитом.
+ANNOTATE_WORKERS = 4
+ANNOTATE_RPM     = 500
+ANNOTATE_TPM     = 200_000
+
+# Лимиты embeddings: 0 — пока сервер не сообщит свои в x-ratelimit-*.
+EMBED_RPM = 0
+EMBED_TPM = 0
+
+# Повторы запросов к API (429, таймауты, обрывы, 5xx): экспоненциальная
+# пауза с полным джиттером; retry-after сервера — нижняя граница.
+API_TIMEOUT    = 60.0   # с на один запрос
+RETRY_ATTEMPTS = 6
+RETRY_BASE     = 1.0    # с — потолок первой паузы, дальше ×2
+RETRY_MAX      = 60.0
+
+# --plan: оценка прогона без API. Цены — USD за 1M токенов (вход, выход);
+# модели не из списка (локальные эмбеддеры) считаются бесплатными.
+PRICES = {
+    "text-embedding-3-large": (0.13, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "gpt-4o-mini":            (0.15, 0.60),
+}
+# Метрики прогона: JSON в METRICS_FILE после каждого прогона; Prometheus
+# text format — в файл из --prometheus (для textfile-коллектора node_exporter).
+METRICS_PROM_FILE: Path | None = None
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)   # с
+
+# --watch: пачка правок индексируется, когда запись утихла на WATCH_DEBOUNCE
+# секунд (но не позже WATCH_MAX_DELAY от первой правки).
+WATCH_POLL      = 2.0    # с — период опроса, если нет inotify
+WATCH_DEBOUNCE  = 1.0
+WATCH_MAX_DELAY = 10.0
+
+ANNOTATE_EST_OUTPUT = 120   # токенов в типичной аннотации (2–4 предложения)
+ANNOTATE_LATENCY    = 2.0   # с на один запрос аннотации
+EMBED_LATENCY       = 1.5   # с на один запрос к embeddings
 
 
 # ── Инфраструктура ────────────────────────────────────────────────────────────
 
-def load_api_key() -> str:
-    with open(CONFIG_FILE, encoding="utf-8") as f:
-        return json.load(f)["api_key"]
+EMBEDDER: Embedder | None = None   # создаётся в __main__ по EMBEDDER_SPEC
+
+
+def collection_name() -> str:
+    """
+    У каждого эмбеддера и размерности своя коллекция: clody_spark,
+    clody_spark_d512, clody_spark_local_intfloat-multilingual-e5-small…
+    """
+    return layout.collection_name(EMBEDDER_SPEC, EMBED_DIMENSIONS)
 
 
 def get_collection(client=None):
     if client is None:
         client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-    return client.get_or_create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"},
+    collection = client.get_or_create_collection(
+        name=collection_name(),
+        metadata={
+            "hnsw:space":       "cosine",
+            "embedder":         EMBEDDER.spec,
+            "embed_model":      EMBEDDER.model,
+            "embed_dimensions": EMBEDDER.dimensions,
+        },
     )
+    # у коллекций, созданных до появления эмбеддеров, ключа нет — это openai
+    built = (collection.metadata or {}).get("embedder", DEFAULT_EMBEDDER)
+    if built != EMBEDDER.spec:
+        raise RuntimeError(
+            f"Коллекция {collection.name} построена эмбеддером {built}, "
+            f"а сейчас настроен {EMBEDDER.spec}"
+        )
+    dims = collection_dimensions(collection)
+    if dims is not None and dims != EMBEDDER.dimensions:
+        raise RuntimeError(
+            f"Коллекция {collection.name} построена с размерностью {dims}, "
+            f"а сейчас настроено {EMBEDDER.dimensions} — запросы и индекс несовместимы"
+        )
+    return collection
+
 
+_CJK_RE      = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+_CYRILLIC_RE = re.compile(r"[\u0400-\u04ff]")
 
-def embed(texts: list[str], oai: OpenAI) -> list[list[float]]:
-    response = oai.embeddings.create(
-        model="text-embedding-3-large",
-        input=texts,
+
+def estimate_tokens(text: str) -> int:
+    """
+    Быстрая оценка числа токенов cl100k без токенизатора. Коэффициенты
+    откалиброваны по корпусу: кириллица ≈ 2.7 символа на токен, CJK ≈ 1
+    токен на иероглиф, латиница и пунктуация ≈ 3.8 символа на токен.
+    """
+    cjk      = len(_CJK_RE.findall(text))
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    other    = len(text) - cjk - cyrillic
+    return int(cjk + cyrillic / 2.7 + other / 3.8) + 1
+
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Точное число токенов через tiktoken, если он установлен; иначе оценка."""
+    global _encoding, tiktoken
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding(TOKENIZER)
+        except Exception:   # нет сети для загрузки словаря и т. п.
+            tiktoken = None
+    if _encoding is None:
+        return estimate_tokens(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+class RateLimiter:
+    """
+    Два token bucket'а: запросы в минуту и токены в минуту.
+    Потокобезопасен; 0 — без ограничения по этому измерению.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm      = rpm
+        self.tpm      = tpm
+        self.requests = float(rpm)
+        self.tokens   = float(tpm)
+        self.stamp    = time.monotonic()
+        self.resume   = 0.0   # monotonic: до этого момента запросов не шлём (429, остаток 0)
+        self.lock     = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self.lock:
+                wait = self._take(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take(self, tokens: int) -> float:
+        """Под lock: 0 — запрос разрешён и учтён, иначе сколько ждать."""
+        now        = time.monotonic()
+        elapsed    = now - self.stamp
+        self.stamp = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            tokens      = min(tokens, self.tpm)
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        if now < self.resume:
+            return self.resume - now
+        ok_req = not self.rpm or self.requests >= 1
+        ok_tok = not self.tpm or self.tokens >= tokens
+        if ok_req and ok_tok:
+            if self.rpm:
+                self.requests -= 1
+            if self.tpm:
+                self.tokens -= tokens
+            return 0.0
+        return max(
+            (1 - self.requests) * 60 / self.rpm if not ok_req else 0,
+            (tokens - self.tokens) * 60 / self.tpm if not ok_tok else 0,
+            0.01,
+        )
+
+    def pause(self, seconds: float):
+        """Приостанавливает всех ждущих на seconds (429 от сервера)."""
+        with self.lock:
+            self.resume = max(self.resume, time.monotonic() + seconds)
+
+    def observe(self, headers):
+        """
+        Подстраивается под заголовки x-ratelimit-* ответа: лимит сервера
+        ниже заданного (или при заданном 0) становится нашим, исчерпанный
+        остаток приостанавливает запросы до сброса окна.
+        """
+        for kind, attr, bucket in (("requests", "rpm", "requests"), ("tokens", "tpm", "tokens")):
+            limit = header_number(headers, f"x-ratelimit-limit-{kind}")
+            if limit:
+                with self.lock:
+                    current = getattr(self, attr)
+                    if not current or limit < current:
+                        setattr(self, attr, int(limit))
+                        setattr(self, bucket, min(getattr(self, bucket), limit) if current else limit)
+            if header_number(headers, f"x-ratelimit-remaining-{kind}") == 0:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+                if reset:
+                    self.pause(reset)
+
+
+def header_number(headers, name: str) -> float | None:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_duration(text: str) -> float:
+    """Длительность в формате OpenAI: «20ms», «1.5s», «6m0s» → секунды."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * units[u] for n, u in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", text))
+
+
+ANNOTATE_LIMITER = RateLimiter(ANNOTATE_RPM, ANNOTATE_TPM)
+EMBED_LIMITER    = RateLimiter(EMBED_RPM, EMBED_TPM)
+_annotate_pool: ThreadPoolExecutor | None = None
+
+RETRYABLE = (openai.RateLimitError, openai.APITimeoutError,
+             openai.APIConnectionError, openai.InternalServerError)
+
+
+def openai_client() -> OpenAI:
+    """
+    Клиент индексатора: вместо встроенных повторов SDK — call_api, а
+    заголовки x-ratelimit-* каждого ответа (и 429 тоже) подстраивают
+    limiter своего эндпоинта.
+    """
+    def observe(response):
+        path = response.request.url.path
+        (EMBED_LIMITER if path.endswith("/embeddings") else ANNOTATE_LIMITER).observe(response.headers)
+
+    return OpenAI(
+        api_key     = load_api_key(),
+        max_retries = 0,
+        timeout     = API_TIMEOUT,
+        http_client = openai.DefaultHttpxClient(event_hooks={"response": [observe]}),
     )
-    return [item.embedding for item in response.data]
+
+
+def retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    if (ms := header_number(response.headers, "retry-after-ms")) is not None:
+        return ms / 1000
+    return header_number(response.headers, "retry-after")
+
+
+def call_api(limiter: RateLimiter, tokens: int, request, name: str):
+    """
+    request() под limiter с повторами: 429, таймауты, обрывы и 5xx
+    повторяются до RETRY_ATTEMPTS раз. 429 приостанавливает весь limiter,
+    чтобы остальные потоки не добивали лимит. Время ожидания и каждой
+    попытки идёт в METRICS (name_wait, name), повторы — в retries.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        with METRICS.timer(f"{name}_wait"):
+            limiter.acquire(tokens)
+        try:
+            with METRICS.timer(name):
+                return request()
+        except RETRYABLE as e:
+            if attempt == RETRY_ATTEMPTS - 1 or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            delay = random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt))
+            hint  = retry_after(e)
+            if hint is not None:
+                delay += hint
+            METRICS.count("retries")
+            METRICS.count(f"{name}_retries")
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
+
+class Metrics:
+    """
+    Метрики одного прогона: длительности (стадии конвейера и задержки API,
+    по каждому наблюдению) и счётчики (токены, запросы, чанки).
+    Потокобезопасны — пишутся из стадий и пула аннотаций.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started  = time.time()
+            self.clock    = time.monotonic()
+            self.counters: dict[str, float]       = {}
+            self.timings:  dict[str, list[float]] = {}
+
+    def count(self, name: str, n: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        with self.lock:
+            wall     = time.monotonic() - self.clock
+            counters = dict(self.counters)
+            timings  = {k: sorted(v) for k, v in self.timings.items()}
+        return {
+            "started":      time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": round(wall, 3),
+            "embedder":     EMBEDDER.spec if EMBEDDER else None,
+            "collection":   collection_name() if EMBEDDER else None,
+            "counters":     counters,
+            "timings":      {
+                name: {
+                    "count": len(v),
+                    "total": round(sum(v), 3),
+                    "p50":   round(v[len(v) // 2], 4),
+                    "p95":   round(v[min(len(v) - 1, int(len(v) * 0.95))], 4),
+                    "max":   round(v[-1], 4),
+                }
+                for name, v in timings.items()
+            },
+            "per_second":   {
+                name: round(counters.get(name, 0) / wall, 2) if wall else 0.0
+                for name in ("docs", "chunks", "embed_tokens")
+            },
+        }
+
+    def prometheus(self) -> str:
+        """Text exposition format: счётчики — *_total, длительности — гистограммы."""
+        with self.lock:
+            wall     = time.monotonic() - self.clock
+            counters = dict(self.counters)
+            timings  = {k: list(v) for k, v in self.timings.items()}
+        lines = [
+            "# TYPE clody_index_wall_seconds gauge",
+            f"clody_index_wall_seconds {wall:.3f}",
+            "# TYPE clody_index_started_timestamp_seconds gauge",
+            f"clody_index_started_timestamp_seconds {self.started:.0f}",
+        ]
+        for name, value in sorted(counters.items()):
+            lines += [f"# TYPE clody_index_{name}_total counter", f"clody_index_{name}_total {value:g}"]
+        for name, values in sorted(timings.items()):
+            metric = f"clody_index_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for le in LATENCY_BUCKETS:
+                lines.append(f'{metric}_bucket{{le="{le}"}} {sum(1 for v in values if v <= le)}')
+            lines += [
+                f'{metric}_bucket{{le="+Inf"}} {len(values)}',
+                f"{metric}_sum {sum(values):.4f}",
+                f"{metric}_count {len(values)}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> list[str]:
+        """Короткая таблица для консоли."""
+        summary = self.summary()
+        rate    = summary["per_second"]
+        lines   = [f"Метрики: {summary['wall_seconds']:.1f} с, "
+                   f"{rate['docs']} док/с, {rate['chunks']} чанков/с, {rate['embed_tokens']:.0f} ток/с"]
+        for name, t in summary["timings"].items():
+            lines.append(f"  {name:<15} ×{t['count']:<6} всего {t['total']:8.2f} с   "
+                         f"p50 {t['p50']:.3f}  p95 {t['p95']:.3f}  max {t['max']:.3f}")
+        return lines
+
+    def save(self):
+        """JSON — в METRICS_FILE, Prometheus — в METRICS_PROM_FILE; оба атомарно."""
+        outputs = [(METRICS_FILE, json.dumps(self.summary(), ensure_ascii=False, indent=1))]
+        if METRICS_PROM_FILE is not None:
+            outputs.append((METRICS_PROM_FILE, self.prometheus()))
+        for path, text in outputs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            tmp.write_text(text, encoding="utf-8")
+            os.replace(tmp, path)
+
+
+METRICS = Metrics()
+
+
+def annotate_pool() -> ThreadPoolExecutor:
+    global _annotate_pool
+    if _annotate_pool is None:
+        _annotate_pool = ThreadPoolExecutor(
+            max_workers=ANNOTATE_WORKERS, thread_name_prefix="annotate",
+        )
+    return _annotate_pool
+
+
+class EmbedCache:
+    """
+    Дисковый кэш векторов: SQLite, ключ (model, dimensions, sha256(text)).
+    Векторы хранятся как float32 или, с --compact, как float16 — вдвое
+    меньше места при погрешности ~1e-3, несущественной для косинуса.
+    Переживает удаление chroma/ и переименование коллекции — пересборка
+    индекса без сети.
+    """
+
+    def __init__(self, path: Path, max_rows: int = EMBED_CACHE_MAX):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db       = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock     = threading.Lock()
+        self.max_rows = max_rows
+        self.hits     = 0
+        self.misses   = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " model TEXT, dimensions INTEGER, hash TEXT, vector BLOB, used REAL,"
+            " PRIMARY KEY (model, dimensions, hash))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(vectors)")]
+        if "dtype" not in columns:
+            self.db.execute("ALTER TABLE vectors ADD COLUMN dtype TEXT DEFAULT 'f'")
+        self.db.commit()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def pack(vector, dtype: str) -> bytes:
+        if dtype == "e":
+            return struct.pack(f"<{len(vector)}e", *vector)
+        return array("f", vector).tobytes()
+
+    @staticmethod
+    def unpack(blob: bytes, dtype: str) -> list[float]:
+        if dtype == "e":
+            return list(struct.unpack(f"<{len(blob) // 2}e", blob))
+        vec = array("f")
+        vec.frombytes(blob)
+        return vec.tolist()
+
+    def get_many(self, model: str, dimensions: int, texts: list[str],
+                 count: bool = True) -> dict[str, list[float]]:
+        """{text: vector} для найденных в кэше."""
+        by_hash = {self.key(t): t for t in texts}
+        found   = {}
+        hashes  = list(by_hash)
+        with self.lock:
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT hash, vector, dtype FROM vectors WHERE model = ? AND dimensions = ?"
+                    f" AND hash IN ({','.join('?' * len(part))})",
+                    (model, dimensions, *part),
+                ).fetchall()
+                for h, blob, dtype in rows:
+                    found[by_hash[h]] = self.unpack(blob, dtype)
+            if found:
+                now = time.time()
+                self.db.executemany(
+                    "UPDATE vectors SET used = ? WHERE model = ? AND dimensions = ? AND hash = ?",
+                    [(now, model, dimensions, self.key(t)) for t in found],
+                )
+                self.db.commit()
+            if count:
+                self.hits   += len(found)
+                self.misses += len(by_hash) - len(found)
+        return found
+
+    def put_many(self, model: str, dimensions: int, texts: list[str], vectors):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO vectors (model, dimensions, hash, vector, used, dtype)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(model, dimensions, self.key(t), self.pack(v, EMBED_CACHE_DTYPE), now,
+                  EMBED_CACHE_DTYPE)
+                 for t, v in zip(texts, vectors)],
+            )
+            (count,) = self.db.execute("SELECT COUNT(*) FROM vectors").fetchone()
+            if count > self.max_rows:
+                self.db.execute(
+                    "DELETE FROM vectors WHERE rowid IN"
+                    " (SELECT rowid FROM vectors ORDER BY used LIMIT ?)",
+                    (count - self.max_rows,),
+                )
+            self.db.commit()
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        ratio = f"{self.hits / total:.0%}" if total else "—"
+        return f"кэш эмбеддингов: попаданий {self.hits}, промахов {self.misses} ({ratio})"
+
+
+EMBED_CACHE: EmbedCache | None = None   # включается в __main__, если не --no-cache
+
+
+def shorten(vector, dimensions: int) -> list[float]:
+    """
+    Укорачивает вектор text-embedding-3 до dimensions с перенормировкой —
+    это эквивалентно запросу с параметром dimensions (Matryoshka-обучение).
+    """
+    head = vector[:dimensions]
+    norm = math.sqrt(sum(x * x for x in head)) or 1.0
+    return [x / norm for x in head]
+
+
+def embed_batch(texts: list[str], query: bool = False) -> list[list[float]]:
+    """
+    Один запрос к EMBEDDER через call_api. Батч, отвергнутый API как
+    слишком большой (400/413), делится пополам и отправляется по частям.
+    """
+    tokens = sum(count_tokens(t) for t in texts)
+    try:
+        vectors = call_api(EMBED_LIMITER, tokens, lambda: EMBEDDER.embed(texts, query=query), "embed")
+    except openai.APIStatusError as e:
+        if len(texts) == 1 or e.status_code not in (400, 413):
+            raise
+        METRICS.count("embed_splits")
+        mid = len(texts) // 2
+        return embed_batch(texts[:mid], query) + embed_batch(texts[mid:], query)
+    METRICS.count("embed_requests")
+    METRICS.count("embed_texts", len(texts))
+    METRICS.count("embed_tokens", tokens)
+    return vectors
+
+
+def embed(texts: list[str], query: bool = False) -> list[list[float]]:
+    """
+    Эмбеддинги через EMBEDDER с учётом EMBED_CACHE: в модель уходят только
+    отсутствующие тексты. У openai при EMBED_DIMENSIONS недостающее сначала
+    выводится из закэшированных полноразмерных векторов.
+    """
+    cache = EMBED_CACHE if EMBEDDER.cacheable else None
+    model = EMBEDDER.cache_key(query)
+    found = {}
+    if cache is not None:
+        found = cache.get_many(model, EMBED_DIMENSIONS, texts)
+        if EMBED_DIMENSIONS and EMBEDDER.backend == "openai" and len(found) < len(texts):
+            full = cache.get_many(
+                model, 0, [t for t in texts if t not in found], count=False,
+            )
+            derived = {t: shorten(v, EMBED_DIMENSIONS) for t, v in full.items()}
+            if derived:
+                cache.put_many(model, EMBED_DIMENSIONS, list(derived), list(derived.values()))
+                cache.hits   += len(derived)
+                cache.misses -= len(derived)
+            found.update(derived)
+        METRICS.count("embed_cache_hits", len(found))
+    missing = list(dict.fromkeys(t for t in texts if t not in found))
+    if missing:
+        vectors = embed_batch(missing, query)
+        found.update(zip(missing, vectors))
+        if cache is not None:
+            cache.put_many(model, EMBED_DIMENSIONS, missing, vectors)
+    return [found[t] for t in texts]
+
+
+class AnnotationCache:
+    """
+    Дисковый кэш аннотаций: ключ — sha256 от (системный промпт, модель,
+    температура, max_tokens, context, text). Переживает пересборку коллекции
+    и эксперименты с CHUNK_TOKENS. Версия промпта (prompt_hash) хранится отдельно —
+    по ней находятся устаревшие записи после правки промпта.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db     = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock   = threading.Lock()
+        self.hits   = 0
+        self.misses = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts ("
+            " prompt_hash TEXT PRIMARY KEY, model TEXT, temperature REAL,"
+            " max_tokens INTEGER, system TEXT, created REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS annotations ("
+            " key TEXT PRIMARY KEY, prompt_hash TEXT, annotation TEXT, used REAL)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def prompt_hash() -> str:
+        return content_hash(json.dumps(
+            [ANNOTATE_SYSTEM, ANNOTATE_MODEL, ANNOTATE_TEMPERATURE, ANNOTATE_MAX_TOKENS],
+            ensure_ascii=False,
+        ))
+
+    @classmethod
+    def key(cls, text: str, context: str) -> str:
+        return content_hash(json.dumps([cls.prompt_hash(), context, text], ensure_ascii=False))
+
+    def peek(self, text: str, context: str) -> str | None:
+        """Как get, но без счётчиков и отметки used — для --plan."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT annotation FROM annotations WHERE key = ?", (self.key(text, context),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, text: str, context: str) -> str | None:
+        key = self.key(text, context)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT annotation FROM annotations WHERE key = ?", (key,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE annotations SET used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return row[0]
+
+    def put(self, text: str, context: str, annotation: str):
+        ph = self.prompt_hash()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO prompts VALUES (?, ?, ?, ?, ?, ?)",
+                (ph, ANNOTATE_MODEL, ANNOTATE_TEMPERATURE, ANNOTATE_MAX_TOKENS,
+                 ANNOTATE_SYSTEM, time.time()),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                (self.key(text, context), ph, annotation, time.time()),
+            )
+            self.db.commit()
+
+    def versions(self) -> list[tuple]:
+        """[(prompt_hash, model, temperature, system, записей, текущая?)]"""
+        current = self.prompt_hash()
+        rows = self.db.execute(
+            "SELECT a.prompt_hash, p.model, p.temperature, p.system, COUNT(*)"
+            " FROM annotations a LEFT JOIN prompts p USING (prompt_hash)"
+            " GROUP BY a.prompt_hash ORDER BY MAX(a.used) DESC"
+        ).fetchall()
+        return [(*r, r[0] == current) for r in rows]
+
+    def prune(self) -> int:
+        """Удаляет аннотации, сделанные не текущим промптом/моделью."""
+        current = self.prompt_hash()
+        with self.lock:
+            cur = self.db.execute("DELETE FROM annotations WHERE prompt_hash != ?", (current,))
+            self.db.execute("DELETE FROM prompts WHERE prompt_hash != ?", (current,))
+            self.db.commit()
+        self.db.execute("VACUUM")
+        return cur.rowcount
+
+    def summary(self) -> str:
+        return f"кэш аннотаций: попаданий {self.hits}, промахов {self.misses}"
+
+
+ANNOTATION_CACHE: AnnotationCache | None = None   # включается в __main__, если не --no-cache
 
 
 def annotate(text: str, oai: OpenAI, context: str = "") -> str:
     """Краткая аннотация через GPT-4o-mini. context — подсказка (дата, заголовок)."""
-    system = (
-        "Ты помогаешь индексировать тексты из дневника. "
-        "Напиши очень краткую аннотацию (2–4 предложения) для семантического поиска: "
-        "о чём текст, какие ключевые идеи, настроение. Без вступлений."
-    )
+    if ANNOTATION_CACHE is not None:
+        cached = ANNOTATION_CACHE.get(text, context)
+        if cached is not None:
+            METRICS.count("annotation_cache_hits")
+            return cached
+
+    if oai is None:
+        raise RuntimeError(f"Для аннотаций нужен ключ OpenAI в {CONFIG_FILE}")
     user = f"{context}\n\n{text}".strip() if context else text
-    resp = oai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user",   "content": user},
-        ],
-        max_tokens=200,
-        temperature=0.3,
+    resp = call_api(
+        ANNOTATE_LIMITER,
+        count_tokens(ANNOTATE_SYSTEM + user) + ANNOTATE_MAX_TOKENS,
+        lambda: oai.chat.completions.create(
+            model=ANNOTATE_MODEL,
+            messages=[
+                {"role": "system", "content": ANNOTATE_SYSTEM},
+                {"role": "user",   "content": user},
+            ],
+            max_tokens=ANNOTATE_MAX_TOKENS,
+            temperature=ANNOTATE_TEMPERATURE,
+        ),
+        "annotate",
     )
-    return resp.choices[0].message.content.strip()
+    annotation = resp.choices[0].message.content.strip()
+    METRICS.count("annotations")
+    if getattr(resp, "usage", None) is not None:
+        METRICS.count("annotate_tokens_in",  resp.usage.prompt_tokens)
+        METRICS.count("annotate_tokens_out", resp.usage.completion_tokens)
+    if ANNOTATION_CACHE is not None:
+        ANNOTATION_CACHE.put(text, context, annotation)
+    return annotation
+
+
+def annotation_cache_command(action: str):
+    cache = ANNOTATION_CACHE or AnnotationCache(ANNOTATION_CACHE_FILE)
+    if action == "prune":
+        print(f"Удалено устаревших аннотаций: {cache.prune()}")
+        return
+    versions = cache.versions()
+    if not versions:
+        print("Кэш аннотаций пуст")
+    for ph, model, temperature, system, count, current in versions:
+        mark = "текущий" if current else "устаревший"
+        print(f"{ph[:12]} [{mark}] {model} t={temperature}: {count} аннотаций")
+        print(f"  {(system or '')[:100]}")
 
 
 # ── Чанкинг ───────────────────────────────────────────────────────────────────
 
 def split_paragraphs(text: str) -> list[str]:
-    """Делит на абзацы, склеивает слишком короткие с соседом."""
-    raw    = [p.strip() for p in re.split(r"\n{2,}", text) if p.strip()]
-    merged = []
-    buf    = ""
-    for p in raw:
-        if buf and len(buf) + len(p) + 2 < SHORT // 2:
-            buf += "\n\n" + p          # склеиваем короткие
-        else:
-            if buf:
-                merged.append(buf)
-            buf = p
-    if buf:
-        merged.append(buf)
-    return merged
+    """Делит на абзацы (для стихов — строфы)."""
+    return [p.strip() for p in re.split(r"\n{2,}", text) if p.strip()]
 
 
-def get_embed_items(
-    doc_id: str,
-    text: str,
-    meta_base: dict,
-    oai: OpenAI,
-    context: str = "",
-) -> list[dict]:
+def chunker_signature() -> str:
+    """Параметры чанкинга; при их смене файлы перечанкиваются."""
+    return f"tokens:{CHUNK_TOKENS}/{CHUNK_OVERLAP}"
+
+
+def pack_paragraphs(paragraphs: list[str]) -> list[tuple[str, int, bool]]:
+    """
+    Упаковывает подряд идущие абзацы в чанки до CHUNK_TOKENS.
+    Возвращает [(текст, токенов, нужна_аннотация)]. Абзац длиннее бюджета
+    идёт отдельным чанком на аннотацию. Перекрытие: в начало следующего
+    чанка переносятся последние абзацы предыдущего, суммарно до CHUNK_OVERLAP.
     """
-    Возвращает список готовых к записи чанков:
-    [{"id": ..., "embed_text": ..., "document": ..., "metadata": ...}]
+    chunks: list[tuple[str, int, bool]] = []
+    buf:    list[tuple[str, int]]       = []
+    fresh = False   # есть ли в buf что-то кроме перенесённого перекрытия
+
+    def emit():
+        nonlocal buf, fresh
+        if fresh:
+            chunks.append(("\n\n".join(p for p, _ in buf), sum(t for _, t in buf), False))
+        tail, total = [], 0
+        for p, t in reversed(buf):
+            if total + t > CHUNK_OVERLAP:
+                break
+            tail.insert(0, (p, t))
+            total += t
+        buf, fresh = tail, False
+
+    for para in paragraphs:
+        tokens = count_tokens(para)
+        if tokens > CHUNK_TOKENS:
+            emit()
+            buf = []
+            chunks.append((para, tokens, True))
+            continue
+        if buf and sum(t for _, t in buf) + tokens > CHUNK_TOKENS:
+            emit()
+            if sum(t for _, t in buf) + tokens > CHUNK_TOKENS:
+                buf = []
+        buf.append((para, tokens))
+        fresh = True
+    emit()
+    return chunks
+
+
+def chunk_layout(doc_id: str, text: str) -> list[tuple[str, str, int, str]]:
+    """
+    Раскладка документа на чанки без обращений к API:
+    [(id, текст, токенов, стратегия)], стратегия — full_text или annotation.
+    Общая для индексации и --plan.
     """
     text = text.strip()
     if not text:
         return []
 
-    if len(text) < SHORT:
+    tokens = count_tokens(text)
+    if tokens <= CHUNK_TOKENS:
         # Короткий — берём как есть
-        return [{
-            "id":         doc_id,
-            "embed_text": text,
-            "document":   text,
-            "metadata":   {**meta_base, "strategy": "full_text", "chunk": 0},
-        }]
-
-    # Длинный — разбиваем на абзацы
-    paragraphs = split_paragraphs(text)
+        return [(doc_id, text, tokens, "full_text")]
 
-    if len(paragraphs) == 1:
+    # Длинный — разбиваем на абзацы и пакуем по бюджету
+    chunks = pack_paragraphs(split_paragraphs(text))
+    if len(chunks) == 1 and chunks[0][2]:
         # Единый длинный абзац — одна аннотация
-        ann = annotate(text, oai, context)
-        return [{
-            "id":         doc_id,
-            "embed_text": ann,
-            "document":   text[:500],   # preview для отображения
-            "metadata":   {**meta_base, "strategy": "annotation", "chunk": 0},
-        }]
-
-    # Несколько абзацев — каждый независимо
+        return [(doc_id, text, tokens, "annotation")]
+
+    return [
+        (f"{doc_id}__c{i}", chunk, chunk_tokens, "annotation" if long else "full_text")
+        for i, (chunk, chunk_tokens, long) in enumerate(chunks)
+    ]
+
+
+def plan_embed_items(
+    doc_id: str,
+    text: str,
+    meta_base: dict,
+    oai: OpenAI,
+    context: str = "",
+) -> list[dict]:
+    """
+    Чанки документа к записи: [{"id", "embed_text", "document", "text", "metadata"}].
+    Аннотаций не ждёт: у чанков со стратегией annotation в embed_text лежит
+    Future из annotate_pool(), их дожидается resolve_embed_items. Позволяет
+    аннотировать абзацы нескольких документов одновременно.
+    """
     items = []
-    for i, para in enumerate(paragraphs):
-        chunk_id = f"{doc_id}__c{i}"
-        if len(para) < SHORT:
+    for i, (item_id, chunk, tokens, strategy) in enumerate(chunk_layout(doc_id, text)):
+        meta = {**meta_base, "strategy": strategy, "chunk": i, "tokens": tokens}
+        if strategy == "annotation":
             items.append({
-                "id":         chunk_id,
-                "embed_text": para,
-                "document":   para,
-                "metadata":   {**meta_base, "strategy": "full_text", "chunk": i},
+                "id":         item_id,
+                "embed_text": annotate_pool().submit(annotate, chunk, oai, context),
+                "document":   chunk[:500],   # preview для отображения
+                "text":       chunk,         # целиком — для лексического индекса
+                "metadata":   meta,
             })
         else:
-            ann = annotate(para, oai, context)
             items.append({
-                "id":         chunk_id,
-                "embed_text": ann,
-                "document":   para[:500],
-                "metadata":   {**meta_base, "strategy": "annotation", "chunk": i},
+                "id":         item_id,
+                "embed_text": chunk,
+                "document":   chunk,
+                "metadata":   meta,
             })
     return items
 
 
+def resolve_embed_items(items: list[dict]) -> list[dict]:
+    """Дожидается аннотаций; порядок чанков сохраняется."""
+    for it in items:
+        if isinstance(it["embed_text"], Future):
+            it["embed_text"] = it["embed_text"].result()
+    return items
+
+
+# ── Манифест ──────────────────────────────────────────────────────────────────
+
+def manifest_file() -> Path:
+    """У каждой коллекции свой манифест — см. collection_name()."""
+    return layout.manifest_file(collection_name())
+
+
+def load_manifest(collection=None) -> dict:
+    """
+    {путь относительно репо: {sha256, mtime, size, ids, strategy, strategies, chunker, tokens}}
+
+    С collection манифест сверяется с ней: записан для другой коллекции
+    (базу удалили и создали заново, коллекцию пересоздали вручную) или
+    коллекция пуста — записи не годятся, и все файлы считаются новыми.
+    Манифест без id коллекции (до этой проверки) принимается, если она не пуста.
+    """
+    path            = manifest_file()
+    owner, manifest = read_manifest(path)
+    if collection is not None and manifest:
+        if owner not in (None, str(collection.id)) or collection.count() == 0:
+            print(f"Манифест {path.name} не соответствует коллекции {collection.name} "
+                  f"— записи сброшены, файлы будут проиндексированы заново")
+            return {}
+    return manifest
+
+
+def save_manifest(manifest: dict, collection):
+    """Пишет атомарно: во временный файл, затем os.replace. Метит id коллекции."""
+    path = manifest_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({MANIFEST_COLLECTION: str(collection.id), **manifest}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def manifest_key(path: Path) -> str:
+    return path.relative_to(REPO_ROOT).as_posix()
+
+
+def content_hash(raw: str) -> str:
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def chunk_strategy(items: list[dict]) -> str:
+    strategies = {it["metadata"]["strategy"] for it in items}
+    return strategies.pop() if len(strategies) == 1 else "mixed"
+
+
+def strategy_counts(items: list[dict]) -> dict[str, int]:
+    """{стратегия: чанков} — хранится в манифесте для --stats."""
+    counts: dict[str, int] = {}
+    for it in items:
+        strategy = it["metadata"]["strategy"]
+        counts[strategy] = counts.get(strategy, 0) + 1
+    return counts
+
+
+def ids_by_doc(ids) -> dict[str, list[str]]:
+    """Группирует id чанков по документу: lj_x__c0, lj_x__c1 → lj_x."""
+    groups: dict[str, list[str]] = {}
+    for i in ids:
+        groups.setdefault(i.split("__c")[0], []).append(i)
+    return groups
+
+
+def replace_chunks(collection, items: list[dict], vectors, old_ids):
+    """
+    Заменяет чанки документа: сначала upsert новых, потом удаление лишних
+    старых. Документ ни в какой момент не пропадает из выдачи.
+    """
+    new_ids = [it["id"] for it in items]
+    if items:
+        collection.upsert(
+            ids        = new_ids,
+            embeddings = vectors,
+            documents  = [it["document"] for it in items],
+            metadatas  = [it["metadata"] for it in items],
+        )
+    stale = sorted(set(old_ids) - set(new_ids))
+    if stale:
+        collection.delete(ids=stale)
+    if LEXICAL is not None:
+        LEXICAL.replace(lexical_docs(items), stale)
+
+
+# ── Лексический индекс ────────────────────────────────────────────────────────
+
+LEXICAL: LexicalIndex | None = None   # открывается в __main__ под коллекцию
+
+
+def lexical_docs(items: list[dict]) -> list[tuple[str, str, str]]:
+    return [
+        (it["id"], lexical.doc_text(it.get("text") or it["document"], it["metadata"]),
+         it["metadata"].get("source", ""))
+        for it in items
+    ]
+
+
+def sync_lexical(collection, verbose=True):
+    """
+    Сверяет лексический индекс с коллекцией — без API. Другая коллекция
+    (база удалена или пересоздана) или другой токенизатор — индекс строится
+    заново; разошлось число чанков — лишние id удаляются, недостающие
+    дочитываются из коллекции. У абзацев-аннотаций в коллекции только начало
+    текста; полный появится при их переиндексации.
+    """
+    owner = str(collection.id)
+    if (LEXICAL.tokenizer == lexical.TOKENIZER and LEXICAL.collection == owner
+            and LEXICAL.count() == collection.count()):
+        return
+    if LEXICAL.tokenizer != lexical.TOKENIZER or LEXICAL.collection not in (None, owner):
+        LEXICAL.clear()
+    have  = LEXICAL.ids()
+    want  = set(iter_collection_ids(collection))
+    stale = sorted(have - want)
+    fresh = sorted(want - have)
+    LEXICAL.delete(stale)
+    for start in range(0, len(fresh), ID_PAGE):
+        res = collection.get(ids=fresh[start:start + ID_PAGE], include=["documents", "metadatas"])
+        LEXICAL.replace([
+            (i, lexical.doc_text(doc or "", meta or {}), (meta or {}).get("source", ""))
+            for i, doc, meta in zip(res["ids"], res["documents"], res["metadatas"])
+        ])
+    LEXICAL.set_collection(owner)
+    if verbose and (stale or fresh):
+        print(f"Лексический индекс сверен с коллекцией: добавлено {len(fresh)}, удалено {len(stale)}")
+
+
+_STOP = object()
+
+
+class Stage(threading.Thread):
+    """
+    Стадия конвейера: поток, который берёт элементы из ограниченной очереди,
+    обрабатывает func и отдаёт результат (если не None) следующей стадии.
+    Полная очередь блокирует put — медленная стадия тормозит предыдущие.
+    После ошибки стадия только вычерпывает очередь, ошибка всплывает при
+    следующем put или при close.
+    """
+
+    def __init__(self, name: str, func, maxsize: int, downstream: "Stage | None" = None,
+                 finish=None):
+        super().__init__(name=name, daemon=True)
+        self.func       = func
+        self.finish     = finish
+        self.queue      = queue.Queue(maxsize)
+        self.downstream = downstream
+        self.error: BaseException | None = None
+        self.start()
+
+    def run(self):
+        while (item := self.queue.get()) is not _STOP:
+            if self.error is not None:
+                continue
+            try:
+                with METRICS.timer(f"stage_{self.name}"):
+                    out = self.func(item)
+                if out is not None and self.downstream is not None:
+                    self.downstream.put(out)
+            except BaseException as e:
+                self.error = e
+        if self.finish is not None and self.error is None:
+            try:
+                self.finish()
+            except BaseException as e:
+                self.error = e
+        if self.downstream is not None:
+            self.downstream.queue.put(_STOP)
+
+    def put(self, item):
+        self.raise_error()
+        self.queue.put(item)
+
+    def raise_error(self):
+        stage = self
+        while stage is not None:
+            if stage.error is not None:
+                raise stage.error
+            stage = stage.downstream
+
+    def close(self):
+        """Дожидается, пока стадия и все следующие за ней доработают."""
+        self.queue.put(_STOP)
+        stage = self
+        while stage is not None:
+            stage.join()
+            stage = stage.downstream
+
+
+class EmbedBatcher:
+    """
+    Копит чанки нескольких документов и отправляет их одним запросом к
+    embeddings. Сброс — по числу чанков или оценке токенов.
+
+    Работает как конвейер из трёх стадий-потоков:
+        resolve — по порядку дожидается аннотаций документа и копит батч;
+        embed   — один запрос к embeddings на батч;
+        write   — upsert в Chroma крупными пачками (WRITE_BATCH чанков).
+    Главный поток тем временем читает и чанкует следующие файлы.
+    Манифест обновляется только после записи, так что прерванный прогон
+    не помечает документы как проиндексированные.
+    """
+
+    def __init__(self, collection, manifest: dict,
+                 max_items: int = 0, max_tokens: int = 0, verbose=True):
+        self.collection = collection
+        self.manifest   = manifest
+        self.max_items  = max_items or EMBED_BATCH_ITEMS
+        self.max_tokens = max_tokens or EMBED_BATCH_TOKENS
+        self.verbose    = verbose
+        self.pending    = []   # (key, entry, items, old_ids, label)
+        self.pending_ids: set[str] = set()
+        self.items      = 0
+        self.tokens     = 0
+        self.docs       = 0
+        self.chunks     = 0
+        self.written    = []   # копится стадией write до WRITE_BATCH чанков
+        self.written_ids: set[str] = set()
+
+        self.writer   = Stage("write", self._write, WRITE_QUEUE, finish=self._write_out)
+        self.embedder = Stage("embed", self._embed, EMBED_QUEUE, downstream=self.writer)
+        self.resolver = Stage("resolve", self._resolve, ANNOTATE_WORKERS * 4)
+
+    def submit(self, key: str, entry: dict, items: list[dict], old_ids, label: str = ""):
+        """Документ, чьи аннотации ещё могут считаться (Future в embed_text)."""
+        self.resolver.put((key, entry, items, old_ids, label))
+
+    def _resolve(self, doc):
+        key, entry, items, old_ids, label = doc
+        self.add(key, entry, resolve_embed_items(items), old_ids, label)
+
+    def add(self, key: str, entry: dict, items: list[dict], old_ids, label: str = ""):
+        tokens = sum(count_tokens(it["embed_text"]) for it in items)
+        ids    = {it["id"] for it in items}
+        if self.pending and (self.items + len(items) > self.max_items
+                             or self.tokens + tokens > self.max_tokens
+                             or ids & self.pending_ids):
+            # upsert не принимает повторяющиеся id в одном вызове
+            self.flush()
+        self.pending_ids |= ids
+        self.pending.append((key, entry, items, old_ids, label))
+        self.items  += len(items)
+        self.tokens += tokens
+
+    def flush(self):
+        """Отдаёт накопленный батч стадии embed (не дожидаясь её)."""
+        if not self.pending:
+            return
+        self.embedder.put(self.pending)
+        self.pending     = []
+        self.pending_ids = set()
+        self.items       = 0
+        self.tokens      = 0
+
+    def _embed(self, pending):
+        texts   = [it["embed_text"] for _, _, its, _, _ in pending for it in its]
+        vectors = []
+        for start in range(0, len(texts), self.max_items):
+            vectors += embed(texts[start:start + self.max_items])
+        return pending, vectors
+
+    def _write(self, batch):
+        pending, vectors = batch
+        ids = {it["id"] for _, _, its, _, _ in pending for it in its}
+        if ids & self.written_ids:
+            self._write_out()
+        self.written.append(batch)
+        self.written_ids |= ids
+        if sum(len(v) for _, v in self.written) >= WRITE_BATCH:
+            self._write_out()
+
+    def _write_out(self):
+        if not self.written:
+            return
+        pending = [doc for p, _ in self.written for doc in p]
+        vectors = [v for _, vs in self.written for v in vs]
+        items   = [it for _, _, its, _, _ in pending for it in its]
+        old_ids = [i for _, _, _, old, _ in pending for i in old]
+        with METRICS.timer("write"):
+            replace_chunks(self.collection, items, vectors, old_ids)
+
+        for key, entry, its, _, label in pending:
+            self.manifest[key] = entry
+            if not its:
+                continue
+            self.docs   += 1
+            self.chunks += len(its)
+            METRICS.count("docs")
+            METRICS.count("chunks", len(its))
+            if self.verbose:
+                chunks_info = f"{len(its)} chunk(s)" if len(its) > 1 else "1 chunk"
+                print(f"  {label} [{entry['strategy']}] {chunks_info}")
+        self.written     = []
+        self.written_ids = set()
+
+    def close(self):
+        """Дописывает всё поставленное в очередь; ошибку стадии поднимает здесь."""
+        self.resolver.close()
+        if self.resolver.error is None:
+            self.flush()
+        self.embedder.close()
+        for stage in (self.resolver, self.embedder):
+            stage.raise_error()
+
+
+def iter_collection_ids(collection, page: int = ID_PAGE):
+    """Все id коллекции страницами — без одного гигантского get()."""
+    offset = 0
+    while True:
+        ids = collection.get(include=[], limit=page, offset=offset)["ids"]
+        yield from ids
+        if len(ids) < page:
+            return
+        offset += page
+
+
+class IndexRun:
+    """
+    Общее состояние одного прогона индексации: манифест, батчер и снимок
+    id коллекции. --source all проводит все источники через один IndexRun —
+    одна коллекция, один снимок id, общие батчи эмбеддингов.
+    """
+
+    def __init__(self, collection, verbose=True, adopt=True):
+        METRICS.reset()
+        self.collection = collection
+        self.manifest   = load_manifest(collection)
+        self.batcher    = EmbedBatcher(collection, self.manifest, verbose=verbose)
+        self.verbose    = verbose
+        # adopt=False — не сверяться с коллекцией: файл без записи в манифесте
+        # считается новым (--watch после начального прогона)
+        self._existing: dict[str, list[str]] | None = None if adopt else {}
+        self.backfill_filters()
+
+    def backfill_filters(self):
+        """
+        Чанкам из записей манифеста старее FILTERS_VERSION дописывает year,
+        day и tag_list (у старых стихов строковый year переезжает в year_text)
+        через collection.update — только метаданные, без эмбеддингов. Отметка в манифесте сохраняется в finish.
+        """
+        stale = [e for e in self.manifest.values() if e.get("filters") != FILTERS_VERSION]
+        ids   = [i for e in stale for i in e.get("ids", [])]
+        updated = 0
+        for start in range(0, len(ids), ID_PAGE):
+            res   = self.collection.get(ids=ids[start:start + ID_PAGE], include=["metadatas"])
+            batch = [(i, filters.filter_fields(meta or {})) for i, meta in zip(res["ids"], res["metadatas"])]
+            batch = [(i, fields) for i, fields in batch if fields]
+            if batch:
+                self.collection.update(ids=[i for i, _ in batch], metadatas=[f for _, f in batch])
+                updated += len(batch)
+        for entry in stale:
+            entry["filters"] = FILTERS_VERSION
+        if updated and self.verbose:
+            print(f"Даты и теги для фильтров дописаны в {updated} чанков")
+
+    def existing_ids(self) -> dict[str, list[str]]:
+        """id, записанные до появления манифеста; читаются один раз за прогон."""
+        if self._existing is None:
+            self._existing = ids_by_doc(iter_collection_ids(self.collection))
+        return self._existing
+
+    def finish(self):
+        """Дожидается конвейера и сохраняет манифест (и при ошибке тоже)."""
+        try:
+            self.batcher.close()
+        finally:
+            save_manifest(self.manifest, self.collection)
+            METRICS.save()
+        if self.verbose:
+            requests = METRICS.counters.get("embed_requests", 0)   # только реальные, без кэша
+            if requests:
+                print(f"  (запросов к embeddings: {requests:.0f})")
+            print(f"Итого в базе: {self.collection.count()}")
+            if METRICS.counters.get("chunks"):
+                print("\n".join(METRICS.report()))
+
+
+def changed_file(path: Path, st, entry: dict | None, chunker: str) -> tuple[str, str] | None:
+    """
+    (текст, sha256) файла, который надо перечанковать, иначе None.
+    Неизменённый файл (mtime и размер совпадают с манифестом) не читается;
+    изменённый по mtime, но не по содержимому — только обновляет mtime в entry.
+    """
+    # Записи без chunker — из времён до токенного чанкинга, их не трогаем
+    same_chunker = entry is not None and entry.get("chunker", chunker) == chunker
+    if same_chunker and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return None
+
+    raw    = path.read_text(encoding="utf-8")
+    digest = content_hash(raw)
+    if same_chunker and entry["sha256"] == digest:
+        entry["mtime"], entry["size"] = st.st_mtime_ns, st.st_size
+        return None
+    return raw, digest
+
+
+def index_files(
+    paths: list[Path],
+    prepare,
+    oai: OpenAI,
+    run: "IndexRun",
+    verbose=True,
+) -> tuple[int, int]:
+    """
+    Общий цикл файловых источников.
+    prepare(path, raw) → {"id", "text", "meta", "context", "label"} или None.
+
+    Что перечанковывать, решает changed_file. Чанки изменённых файлов
+    уходят в конвейер общего для прогона EmbedBatcher; аннотации при этом
+    ещё считаются.
+    Возвращает (документов, чанков) поставлено на запись.
+    """
+    manifest = run.manifest
+    chunker  = chunker_signature()
+    docs = chunks = 0
+
+    for path in paths:
+        key   = manifest_key(path)
+        st    = path.stat()
+        entry = manifest.get(key)
+        with METRICS.timer("parse"):
+            changed = changed_file(path, st, entry, chunker)
+            if changed is None:
+                METRICS.count("files_unchanged")
+                continue
+            raw, digest = changed
+            doc = prepare(path, raw)
+        old_ids = entry["ids"] if entry else []
+
+        if entry is None and doc:
+            # Проиндексирован до появления манифеста — принимаем как есть
+            existing = run.existing_ids()
+            if doc["id"] in existing:
+                manifest[key] = {
+                    "sha256": digest, "mtime": st.st_mtime_ns, "size": st.st_size,
+                    "ids": sorted(existing[doc["id"]]), "strategy": "adopted",
+                }
+                continue
+
+        items = []
+        if doc:
+            with METRICS.timer("chunk"):
+                items = plan_embed_items(
+                    doc_id    = doc["id"],
+                    text      = doc["text"],
+                    meta_base = {**doc["meta"], **filters.filter_fields(doc["meta"])},
+                    oai       = oai,
+                    context   = doc.get("context", ""),
+                )
+        run.batcher.submit(key, {
+            "sha256":     digest,
+            "mtime":      st.st_mtime_ns,
+            "size":       st.st_size,
+            "ids":        [it["id"] for it in items],
+            "strategy":   chunk_strategy(items) if items else "",
+            "strategies": strategy_counts(items),
+            "chunker":    chunker,
+            "tokens":     [it["metadata"]["tokens"] for it in items],
+            "filters":    FILTERS_VERSION,
+        }, items, old_ids, doc["label"] if doc else key)
+        if items:
+            docs   += 1
+            chunks += len(items)
+
+    return docs, chunks
+
+
 # ── Источник: corpus-annotations.md ──────────────────────────────────────────
 
-def parse_corpus_annotations(path: Path) -> list[dict]:
-    text    = path.read_text(encoding="utf-8")
+def parse_corpus_annotations(path: Path, raw: str | None = None) -> list[dict]:
+    text    = raw if raw is not None else path.read_text(encoding="utf-8")
     entries = []
     current_section = ""
 
@@ -190,38 +1460,78 @@ def parse_corpus_annotations(path: Path) -> list[dict]:
     return [e for e in entries if e["annotation"]]
 
 
-def index_corpus(oai: OpenAI, collection, verbose=True):
-    entries      = parse_corpus_annotations(CORPUS_FILE)
-    existing_ids = set(collection.get(include=[])["ids"])
-    new_entries  = [e for e in entries if e["id"] not in existing_ids]
+def corpus_entry_hash(e: dict) -> str:
+    return content_hash(f"{e['title']}\n{e['section']}\n{e['annotation']}")
 
-    if verbose:
-        print(f"Корпус: найдено {len(entries)}, новых {len(new_entries)}")
-    if not new_entries:
-        return
 
-    texts   = [e["annotation"] for e in new_entries]
-    vectors = embed(texts, oai)
-
-    collection.add(
-        ids        = [e["id"] for e in new_entries],
-        embeddings = vectors,
-        documents  = [e["annotation"] for e in new_entries],
-        metadatas  = [
-            {"title": e["title"], "section": e["section"],
-             "source": "corpus", "strategy": "annotation", "chunk": 0}
-            for e in new_entries
-        ],
-    )
+def index_corpus(oai: OpenAI, run: IndexRun, verbose=True) -> tuple[int, int]:
+    """
+    corpus-annotations.md — один файл, много записей. В манифесте кроме
+    хэша файла хранится хэш каждой записи, чтобы перевекторизовать только
+    изменённые аннотации.
+    """
+    manifest = run.manifest
+    key      = manifest_key(CORPUS_FILE)
+    st       = CORPUS_FILE.stat()
+    entry    = manifest.get(key)
+    if entry and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return 0, 0
+
+    raw    = CORPUS_FILE.read_text(encoding="utf-8")
+    digest = content_hash(raw)
+    known  = entry.get("entries", {}) if entry else {}
+
+    entries = parse_corpus_annotations(CORPUS_FILE, raw)
+    hashes  = {e["id"]: corpus_entry_hash(e) for e in entries}
+    if entry is None:
+        # Первый запуск с манифестом: уже записанное в коллекцию не трогаем
+        existing = set(run.collection.get(ids=list(hashes), include=[])["ids"])
+        known    = {i: h for i, h in hashes.items() if i in existing}
+
+    changed = [e for e in entries if known.get(e["id"]) != hashes[e["id"]]]
+    removed = sorted(set(known) - set(hashes))
+
     if verbose:
-        print(f"Корпус: добавлено {len(new_entries)}. Итого в базе: {collection.count()}")
+        print(f"Корпус: найдено {len(entries)}, новых/изменённых {len(changed)}, "
+              f"удалённых {len(removed)}")
+
+    items = [{
+        "id":         e["id"],
+        "embed_text": e["annotation"],
+        "document":   e["annotation"],
+        "metadata":   {"title": e["title"], "section": e["section"],
+                       "source": "corpus", "strategy": "annotation", "chunk": 0},
+    } for e in changed]
+    run.batcher.submit(key, {
+        "sha256":     digest,
+        "mtime":      st.st_mtime_ns,
+        "size":       st.st_size,
+        "ids":        sorted(hashes),
+        "strategy":   "annotation",
+        "strategies": {"annotation": len(hashes)},
+        "entries":    hashes,
+        "filters":    FILTERS_VERSION,
+    }, items, removed, label="corpus-annotations.md")
+    return len(changed), len(changed)
+
+
+def plan_corpus(plan: "IndexPlan", manifest: dict, limit: int = 0):
+    """--plan для корпуса: аннотации уже готовы, эмбеддятся как есть."""
+    entry = manifest.get(manifest_key(CORPUS_FILE))
+    known = entry.get("entries", {}) if entry else {}
+    for e in parse_corpus_annotations(CORPUS_FILE):
+        if known.get(e["id"]) == corpus_entry_hash(e):
+            plan.unchanged += 1
+        else:
+            plan.add_embed(e["annotation"])
 
 
 # ── Источник: lj/ ────────────────────────────────────────────────────────────
 
-def parse_lj_post(path: Path) -> dict | None:
+def parse_lj_post(path: Path, raw: str | None = None) -> dict | None:
     """Парсит один ЖЖ-пост. Возвращает None если пост пустой."""
-    raw  = path.read_text(encoding="utf-8")
+    if raw is None:
+        raw = path.read_text(encoding="utf-8")
     # Хедер / тело
     if "---" in raw:
         header, _, body = raw.partition("---")
@@ -260,68 +1570,30 @@ def parse_lj_post(path: Path) -> dict | None:
     }
 
 
-def index_lj(oai: OpenAI, collection, limit: int = 0, verbose=True):
-    posts = sorted(LJ_DIR.rglob("*.md"))
-    if limit:
-        posts = posts[:limit]
-
-    existing_ids = set(collection.get(include=[])["ids"])
-    total_added  = 0
-
-    for path in posts:
-        post = parse_lj_post(path)
-        if not post:
-            continue
-
-        # Пропускаем если все чанки этого поста уже есть
-        # (проверяем базовый id и id__c0)
-        if post["id"] in existing_ids or f"{post['id']}__c0" in existing_ids:
-            continue
-
-        meta_base = {
+def prepare_lj(path: Path, raw: str) -> dict | None:
+    post = parse_lj_post(path, raw)
+    if not post:
+        return None
+    return {
+        "id":      post["id"],
+        "text":    post["body"],
+        "meta":    {
             "title":  post["title"],
             "date":   post["date"],
             "tags":   post["tags"],
             "source": "lj",
-        }
-
-        items = get_embed_items(
-            doc_id  = post["id"],
-            text    = post["body"],
-            meta_base = meta_base,
-            oai     = oai,
-            context = post["context"],
-        )
-        if not items:
-            continue
-
-        # Эмбеддим батчем
-        vectors = embed([it["embed_text"] for it in items], oai)
-
-        collection.add(
-            ids        = [it["id"]       for it in items],
-            embeddings = vectors,
-            documents  = [it["document"] for it in items],
-            metadatas  = [it["metadata"] for it in items],
-        )
-        total_added += len(items)
-
-        if verbose:
-            chunks_info = f"{len(items)} chunk(s)" if len(items) > 1 else "1 chunk"
-            strategy    = items[0]["metadata"]["strategy"]
-            print(f"  {post['id']} [{strategy}] {chunks_info}")
-
-    if verbose:
-        print(f"\nЖЖ: добавлено {total_added} чанков. Итого в базе: {collection.count()}")
-
+        },
+        "context": post["context"],
+        "label":   post["id"],
+    }
 
-# ── CLI ───────────────────────────────────────────────────────────────────────
 
 # ── Источник: poetry/ ────────────────────────────────────────────────────────
 
-def parse_poem_file(path: Path) -> dict | None:
+def parse_poem_file(path: Path, raw: str | None = None) -> dict | None:
     """Парсит .md файл стихотворения из poetry/{author}/."""
-    raw = path.read_text(encoding="utf-8")
+    if raw is None:
+        raw = path.read_text(encoding="utf-8")
     title_m = re.search(r"^# (.+)", raw, re.MULTILINE)
     title   = title_m.group(1).strip() if title_m else path.stem
     author_m = re.search(r"^Автор:\s*(.+)", raw, re.MULTILINE)
@@ -345,58 +1617,31 @@ def parse_poem_file(path: Path) -> dict | None:
     }
 
 
-def index_poetry(oai: OpenAI, collection, verbose=True):
-    if not POETRY_DIR.exists():
-        if verbose:
-            print("poetry/ не найдена, пропускаем")
-        return
-    existing_ids = set(collection.get(include=[])["ids"])
-    total_added  = 0
-
-    for poem_path in sorted(POETRY_DIR.rglob("*.md")):
-        poem = parse_poem_file(poem_path)
-        if not poem:
-            continue
-        if poem["id"] in existing_ids:
-            continue
-
-        meta = {
-            "title":  poem["title"],
-            "author": poem["author"],
-            "year":   poem["year"],
-            "source": "poetry",
-            "slug":   poem["slug"],
-        }
-        # Стихи векторизуем как есть (без аннотации)
-        items = get_embed_items(
-            doc_id    = poem["id"],
-            text      = poem["body"],
-            meta_base = meta,
-            oai       = oai,
-        )
-        if not items:
-            continue
-
-        vectors = embed([it["embed_text"] for it in items], oai)
-        collection.add(
-            ids        = [it["id"]       for it in items],
-            embeddings = vectors,
-            documents  = [it["document"] for it in items],
-            metadatas  = [it["metadata"] for it in items],
-        )
-        total_added += len(items)
-        if verbose:
-            print(f"  {poem['author']}: {poem['title'][:40]}")
-
-    if verbose:
-        print(f"\nПоэзия: добавлено {total_added}. Итого в базе: {collection.count()}")
+def prepare_poem(path: Path, raw: str) -> dict | None:
+    poem = parse_poem_file(path, raw)
+    if not poem:
+        return None
+    # Стихи векторизуем как есть (без аннотации)
+    return {
+        "id":    poem["id"],
+        "text":  poem["body"],
+        "meta":  {
+            "title":     poem["title"],
+            "author":    poem["author"],
+            "year_text": poem["year"],   # как в файле; числовые year/day — filters.filter_fields
+            "source":    "poetry",
+            "slug":      poem["slug"],
+        },
+        "label": f"{poem['author']}: {poem['title'][:40]}",
+    }
 
 
 # ── Источник: telegram/ ───────────────────────────────────────────────────────
 
-def parse_telegram_post(path: Path) -> dict | None:
+def parse_telegram_post(path: Path, raw: str | None = None) -> dict | None:
     """Парсит .md файл Telegram-поста из telegram/YYYY/MM/."""
-    raw = path.read_text(encoding="utf-8")
+    if raw is None:
+        raw = path.read_text(encoding="utf-8")
     if "---" in raw:
         header, _, body = raw.partition("---")
     else:
@@ -422,74 +1667,703 @@ def parse_telegram_post(path: Path) -> dict | None:
     }
 
 
-def index_telegram(oai: OpenAI, collection, verbose=True):
-    if not TELEGRAM_DIR.exists():
-        if verbose:
-            print("telegram/ не найдена, пропускаем")
-        return
-
-    posts        = sorted(TELEGRAM_DIR.rglob("*.md"))
-    existing_ids = set(collection.get(include=[])["ids"])
-    total_added  = 0
-
-    for path in posts:
-        post = parse_telegram_post(path)
-        if not post:
-            continue
-        if post["id"] in existing_ids or f"{post['id']}__c0" in existing_ids:
-            continue
-
-        meta_base = {
+def prepare_telegram(path: Path, raw: str) -> dict | None:
+    post = parse_telegram_post(path, raw)
+    if not post:
+        return None
+    return {
+        "id":      post["id"],
+        "text":    post["body"],
+        "meta":    {
             "title":  post["title"],
             "date":   post["date"],
             "source": "telegram",
-        }
-        items = get_embed_items(
-            doc_id    = post["id"],
-            text      = post["body"],
-            meta_base = meta_base,
-            oai       = oai,
-            context   = post["context"],
+        },
+        "context": post["context"],
+        "label":   f"{post['id']}: {post['title'][:50]}",
+    }
+
+
+# ── Источник: journal/, daughter/journal/ ───────────────────────────────────
+
+def parse_journal_entry(path: Path, raw: str | None = None, prefix: str = "journal") -> dict | None:
+    """
+    Запись дневника journal/YYYY/MM/DD.md (или week-N.md). Дата — из пути,
+    заголовок — первая строка «# …».
+    """
+    if raw is None:
+        raw = path.read_text(encoding="utf-8")
+    title_m = re.search(r"^# (.+)", raw, re.MULTILINE)
+    title   = title_m.group(1).strip() if title_m else path.stem
+    body    = raw[title_m.end():] if title_m else raw
+    body    = body.strip()
+    if not body:
+        return None
+
+    year, month = path.parent.parent.name, path.parent.name
+    date   = f"{year}-{month}-{path.stem}" if path.stem.isdigit() else f"{year}-{month}"
+    return {
+        "id":      f"{prefix}_{year}-{month}-{path.stem}",
+        "title":   title,
+        "date":    date,
+        "body":    body,
+        "context": f"Дневник, {title}.",
+    }
+
+
+def journal_doc(entry: dict | None, source: str) -> dict | None:
+    if not entry:
+        return None
+    return {
+        "id":      entry["id"],
+        "text":    entry["body"],
+        "meta":    {
+            "title":  entry["title"],
+            "date":   entry["date"],
+            "source": source,
+        },
+        "context": entry["context"],
+        "label":   entry["id"],
+    }
+
+
+def prepare_journal(path: Path, raw: str) -> dict | None:
+    return journal_doc(parse_journal_entry(path, raw, "journal"), "journal")
+
+
+def prepare_daughter_journal(path: Path, raw: str) -> dict | None:
+    return journal_doc(parse_journal_entry(path, raw, "djournal"), "daughter_journal")
+
+
+# ── Источник: texts/ ──────────────────────────────────────────────────────────
+
+def parse_text(path: Path, raw: str | None = None) -> dict | None:
+    """Эссе texts/<раздел>/<slug>.md: заголовок — «# …», раздел — каталог."""
+    if raw is None:
+        raw = path.read_text(encoding="utf-8")
+    title_m = re.search(r"^# (.+)", raw, re.MULTILINE)
+    title   = title_m.group(1).strip() if title_m else path.stem
+    body    = (raw[title_m.end():] if title_m else raw).strip()
+    if not body:
+        return None
+    section = path.parent.name
+    return {
+        "id":      "text_" + path.stem,
+        "title":   title,
+        "section": section,
+        "body":    body,
+        "context": f"Эссе «{title}», раздел {section}.",
+    }
+
+
+def prepare_text(path: Path, raw: str) -> dict | None:
+    text = parse_text(path, raw)
+    if not text:
+        return None
+    return {
+        "id":      text["id"],
+        "text":    text["body"],
+        "meta":    {
+            "title":   text["title"],
+            "section": text["section"],
+            "source":  "texts",
+        },
+        "context": text["context"],
+        "label":   f"{text['id']}: {text['title'][:50]}",
+    }
+
+
+# ── Реестр источников ─────────────────────────────────────────────────────────
+# Файловый источник — каталог и prepare(path, raw); особый — свой файл и
+# функции index(oai, run, verbose), plan(plan, manifest, limit). Имена и
+# названия — в layout.SOURCE_TITLES (их же видит mcp_search.py); новый
+# источник = запись там и здесь; --source all обходит их в том порядке.
+
+SOURCE_HANDLERS = {
+    "corpus":           {"file": CORPUS_FILE, "index": index_corpus, "plan": plan_corpus},
+    "lj":               {"root": LJ_DIR,               "prepare": prepare_lj},
+    "poetry":           {"root": POETRY_DIR,           "prepare": prepare_poem},
+    "telegram":         {"root": TELEGRAM_DIR,         "prepare": prepare_telegram},
+    "journal":          {"root": JOURNAL_DIR,          "prepare": prepare_journal},
+    "daughter_journal": {"root": DAUGHTER_JOURNAL_DIR, "prepare": prepare_daughter_journal},
+    "texts":            {"root": TEXTS_DIR,            "prepare": prepare_text},
+}
+SOURCES = {name: {"title": title, **SOURCE_HANDLERS[name]} for name, title in SOURCE_TITLES.items()}
+
+
+def source_files(name: str, limit: int = 0) -> list[Path]:
+    root  = SOURCES[name]["root"]
+    paths = sorted(root.rglob("*.md")) if root.exists() else []
+    return paths[:limit] if limit else paths
+
+
+def index_source(name: str, oai: OpenAI, run: IndexRun, limit: int = 0, verbose=True):
+    spec = SOURCES[name]
+    if "index" in spec:
+        docs, chunks = spec["index"](oai, run, verbose)
+    else:
+        if not spec["root"].exists():
+            if verbose:
+                print(f"{spec['root'].relative_to(REPO_ROOT)}/ не найдена, пропускаем")
+            return
+        docs, chunks = index_files(source_files(name, limit), spec["prepare"], oai, run, verbose)
+    if verbose:
+        print(f"{spec['title']}: к записи {docs} документов, {chunks} чанков")
+
+
+def index_sources(names: list[str], oai: OpenAI, collection, limit: int = 0, verbose=True):
+    """Один прогон: коллекция открыта один раз, батчи общие для всех источников."""
+    run = IndexRun(collection, verbose=verbose)
+    try:
+        for name in names:
+            index_source(name, oai, run, limit=limit, verbose=verbose)
+    finally:
+        run.finish()
+
+
+# ── Оценка прогона (--plan) ────────────────────────────────────────────────────
+
+def fmt_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+
+class IndexPlan:
+    """
+    Что сделает прогон по одному источнику — без обращений к API:
+    документы и чанки (та же chunk_layout, тот же манифест), вызовы
+    аннотаций и токены с учётом кэшей, стоимость и время под лимитами.
+    """
+
+    def __init__(self, title: str):
+        self.title       = title
+        self.docs        = 0
+        self.unchanged   = 0
+        self.chunks      = 0
+        self.annotations = 0   # вызовов GPT (без попаданий в кэш)
+        self.cached      = 0   # аннотаций из кэша
+        self.prompt      = 0   # токенов на входе аннотаций
+        self.embed_texts: list[tuple[str | None, int]] = []   # (текст или None, токенов)
+
+    def add_doc(self, doc_id: str, text: str, context: str = ""):
+        layout = chunk_layout(doc_id, text)
+        if not layout:
+            return
+        self.docs   += 1
+        self.chunks += len(layout)
+        for _, chunk, tokens, strategy in layout:
+            if strategy != "annotation":
+                self.embed_texts.append((chunk, tokens))
+                continue
+            cached = ANNOTATION_CACHE.peek(chunk, context) if ANNOTATION_CACHE else None
+            if cached is not None:
+                self.cached += 1
+                self.embed_texts.append((cached, count_tokens(cached)))
+                continue
+            user = f"{context}\n\n{chunk}".strip() if context else chunk
+            self.annotations += 1
+            self.prompt      += count_tokens(ANNOTATE_SYSTEM + user)
+            self.embed_texts.append((None, ANNOTATE_EST_OUTPUT))
+
+    def add_embed(self, text: str):
+        """Документ из одного чанка, который эмбеддится как есть (корпус)."""
+        self.docs   += 1
+        self.chunks += 1
+        self.embed_texts.append((text, count_tokens(text)))
+
+    def estimate(self) -> dict:
+        # Векторы, которые уже лежат в кэше эмбеддингов, в API не пойдут
+        known = [t for t, _ in self.embed_texts if t is not None]
+        hit   = set()
+        if EMBED_CACHE is not None and EMBEDDER.cacheable and known:
+            hit = set(EMBED_CACHE.get_many(EMBEDDER.cache_key(), EMBED_DIMENSIONS, known, count=False))
+        pending = [n for t, n in self.embed_texts if t is None or t not in hit]
+
+        # Запросы к embeddings — теми же лимитами, что у EmbedBatcher
+        requests = items = tokens = 0
+        for n in pending:
+            if items and (items >= EMBED_BATCH_ITEMS or tokens + n > EMBED_BATCH_TOKENS):
+                requests += 1
+                items = tokens = 0
+            items  += 1
+            tokens += n
+        requests += 1 if items else 0
+
+        completion = self.annotations * ANNOTATE_EST_OUTPUT
+        embed_in   = sum(pending)
+        cost = (
+            embed_in   * PRICES.get(EMBEDDER.model, (0, 0))[0]
+            + self.prompt * PRICES.get(ANNOTATE_MODEL, (0, 0))[0]
+            + completion  * PRICES.get(ANNOTATE_MODEL, (0, 0))[1]
+        ) / 1e6
+
+        # Аннотации упираются в число потоков, RPM или TPM — что медленнее.
+        # Конвейер эмбеддит параллельно с аннотациями; время локальных
+        # эмбеддеров не оцениваем.
+        annotate_time = max(
+            self.annotations * ANNOTATE_LATENCY / ANNOTATE_WORKERS,
+            self.annotations / ANNOTATE_LIMITER.rpm * 60 if ANNOTATE_LIMITER.rpm else 0,
+            (self.prompt + completion) / ANNOTATE_LIMITER.tpm * 60 if ANNOTATE_LIMITER.tpm else 0,
         )
-        if not items:
+        embed_time = requests * EMBED_LATENCY if EMBEDDER.backend == "openai" else 0.0
+
+        return {
+            "source":              self.title,
+            "docs":                self.docs,
+            "unchanged":           self.unchanged,
+            "chunks":              self.chunks,
+            "annotations":         self.annotations,
+            "annotations_cached":  self.cached,
+            "annotate_tokens_in":  self.prompt,
+            "annotate_tokens_out": completion,
+            "embeds":              len(pending),
+            "embeds_cached":       len(self.embed_texts) - len(pending),
+            "embed_tokens":        embed_in,
+            "embed_requests":      requests,
+            "cost_usd":            cost,
+            "seconds":             max(annotate_time, embed_time),
+        }
+
+
+def plan_source(name: str, manifest: dict, limit: int = 0) -> dict:
+    spec = SOURCES[name]
+    plan = IndexPlan(spec["title"])
+    if "plan" in spec:
+        spec["plan"](plan, manifest, limit)
+        return plan.estimate()
+
+    chunker = chunker_signature()
+    for path in source_files(name, limit):
+        changed = changed_file(path, path.stat(), manifest.get(manifest_key(path)), chunker)
+        if changed is None:
+            plan.unchanged += 1
             continue
+        doc = spec["prepare"](path, changed[0])
+        if doc:
+            plan.add_doc(doc["id"], doc["text"], doc.get("context", ""))
+    return plan.estimate()
 
-        vectors = embed([it["embed_text"] for it in items], oai)
-        collection.add(
-            ids        = [it["id"]       for it in items],
-            embeddings = vectors,
-            documents  = [it["document"] for it in items],
-            metadatas  = [it["metadata"] for it in items],
+
+def print_plan(names: list[str], limit: int = 0):
+    """
+    --plan: разбор и чанкинг без API. Манифест читается, но не сохраняется;
+    документы, ещё не внесённые в манифест, считаются новыми.
+    """
+    manifest = load_manifest()
+    rows     = [plan_source(name, manifest, limit) for name in names]
+    total    = {k: sum(r[k] for r in rows) for k in rows[0] if k != "source"}
+    total["source"] = "Итого"
+
+    print(f"План индексации ({EMBEDDER.spec}, чанк {CHUNK_TOKENS} ток., "
+          f"{ANNOTATE_WORKERS} потоков, {ANNOTATE_LIMITER.rpm} RPM / {ANNOTATE_LIMITER.tpm} TPM):")
+    for r in rows + ([total] if len(rows) > 1 else []):
+        print(f"\n{r['source']}: документов {r['docs']} (без изменений {r['unchanged']}), "
+              f"чанков {r['chunks']}")
+        print(f"  аннотации:  {r['annotations']} вызовов (из кэша {r['annotations_cached']}), "
+              f"~{r['annotate_tokens_in']:,} ток. на входе, ~{r['annotate_tokens_out']:,} на выходе")
+        print(f"  эмбеддинги: {r['embeds']} текстов (из кэша {r['embeds_cached']}), "
+              f"~{r['embed_tokens']:,} ток., {r['embed_requests']} запросов")
+        print(f"  ≈ ${r['cost_usd']:.3f}, ≈ {fmt_duration(r['seconds'])}")
+
+
+# ── Наблюдение (--watch) ───────────────────────────────────────────────────────
+
+def md_files(root: Path) -> dict[Path, tuple[int, int]]:
+    """{путь: (mtime_ns, размер)} всех .md под root (или самого root-файла)."""
+    if root.is_file():
+        st = root.stat()
+        return {root: (st.st_mtime_ns, st.st_size)}
+    found = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            if name.endswith(".md"):
+                path = Path(dirpath) / name
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                found[path] = (st.st_mtime_ns, st.st_size)
+    return found
+
+
+class PollWatcher:
+    """Опрос stat() раз в timeout секунд — только метаданные, файлы не читаются."""
+
+    def __init__(self, roots: list[Path]):
+        self.roots    = roots
+        self.snapshot = self.scan()
+
+    def scan(self) -> dict[Path, tuple[int, int]]:
+        found = {}
+        for root in self.roots:
+            if root.exists():
+                found.update(md_files(root))
+        return found
+
+    def changes(self, timeout: float) -> set[Path]:
+        time.sleep(timeout)
+        current  = self.scan()
+        changed  = {p for p, sig in current.items() if self.snapshot.get(p) != sig}
+        changed |= set(self.snapshot) - set(current)
+        self.snapshot = current
+        return changed
+
+
+class InotifyWatcher:
+    """
+    inotify: рекурсивные watch на каталоги источников. Файловый источник
+    (corpus-annotations.md) отслеживается через каталог, где он лежит.
+    """
+
+    def __init__(self, roots: list[Path]):
+        self.mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM
+                     | inotify_flags.DELETE | inotify_flags.CREATE)
+        self.ino   = INotify()
+        self.dirs:  dict[int, Path] = {}
+        self.files = {r for r in roots if r.is_file()}
+        self.trees = [r for r in roots if r.is_dir()]
+        for root in self.trees:
+            self.add_tree(root)
+        for path in self.files:
+            self.dirs[self.ino.add_watch(str(path.parent), self.mask)] = path.parent
+
+    def add_tree(self, root: Path) -> set[Path]:
+        """Ставит watch на каталог и подкаталоги; возвращает найденные .md."""
+        for dirpath, _, _ in os.walk(root):
+            self.dirs[self.ino.add_watch(dirpath, self.mask)] = Path(dirpath)
+        return set(md_files(root))
+
+    def watched(self, path: Path) -> bool:
+        return path in self.files or (
+            path.suffix == ".md" and any(path.is_relative_to(t) for t in self.trees)
         )
-        total_added += len(items)
-        if verbose:
-            print(f"  {post['id']}: {post['title'][:50]}")
+
+    def changes(self, timeout: float) -> set[Path]:
+        changed = set()
+        for event in self.ino.read(timeout=int(timeout * 1000)):
+            parent = self.dirs.get(event.wd)
+            if parent is None or not event.name:
+                continue
+            path = parent / event.name
+            if event.mask & inotify_flags.ISDIR:
+                if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    changed |= self.add_tree(path)   # новый каталог месяца и т.п.
+                continue
+            if self.watched(path):
+                changed.add(path)
+        return changed
+
+
+def reindex_paths(paths: set[Path], names: list[str], oai: OpenAI, collection, verbose=True):
+    """
+    Индексирует только затронутые файлы. Удалённые сначала убираются из
+    коллекции и манифеста, потом изменённые идут через обычный конвейер.
+    """
+    run = IndexRun(collection, verbose=verbose, adopt=False)
+    try:
+        for path in sorted(p for p in paths if not p.exists()):
+            entry = run.manifest.pop(manifest_key(path), None)
+            if entry and entry["ids"]:
+                collection.delete(ids=entry["ids"])
+                if LEXICAL is not None:
+                    LEXICAL.delete(entry["ids"])
+                if verbose:
+                    print(f"  удалён {manifest_key(path)}: {len(entry['ids'])} чанков")
+        for name in names:
+            spec = SOURCES[name]
+            if "file" in spec:
+                if spec["file"] in paths and spec["file"].exists():
+                    spec["index"](oai, run, verbose)
+                continue
+            touched = sorted(p for p in paths if p.exists() and p.is_relative_to(spec["root"]))
+            if touched:
+                docs, chunks = index_files(touched, spec["prepare"], oai, run, verbose)
+                if verbose:
+                    print(f"{spec['title']}: к записи {docs} документов, {chunks} чанков")
+    finally:
+        run.finish()
+
+
+def watch(names: list[str], oai: OpenAI, collection, verbose=True):
+    """
+    --watch: начальный инкрементальный прогон, затем индексация правок по
+    мере сохранения. Клиент Chroma и коллекция живут весь сеанс; пачки
+    обрабатываются строго по очереди, так что id старых чанков всегда
+    берутся из уже сохранённого манифеста.
+    """
+    roots   = [SOURCES[n].get("file") or SOURCES[n]["root"] for n in names]
+    # наблюдатель создаётся до начального прогона, чтобы не пропустить правки
+    watcher = InotifyWatcher(roots) if INotify is not None else PollWatcher(roots)
+    index_sources(names, oai, collection, verbose=verbose)
+    print(f"\nСлежу за изменениями ({'inotify' if INotify is not None else 'опрос'}): "
+          f"{', '.join(str(r.relative_to(REPO_ROOT)) for r in roots)}. Ctrl+C — выход.")
+
+    pending: set[Path] = set()
+    first = last = 0.0
+    try:
+        while True:
+            changed = watcher.changes(WATCH_DEBOUNCE if pending else WATCH_POLL)
+            now     = time.monotonic()
+            if changed:
+                if not pending:
+                    first = now
+                pending |= changed
+                last     = now
+            if pending and (now - last >= WATCH_DEBOUNCE or now - first >= WATCH_MAX_DELAY):
+                print(f"\n[{time.strftime('%H:%M:%S')}] изменено файлов: {len(pending)}")
+                batch, pending = pending, set()
+                reindex_paths(batch, names, oai, collection, verbose=verbose)
+    except KeyboardInterrupt:
+        print("\nОстановлено")
+
+
+# ── Сборка мусора ─────────────────────────────────────────────────────────────
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) if path.exists() else 0
+
+
+def missing_sources() -> set[str]:
+    """Источники, чьей папки (или файла корпуса) нет: их чанки GC не трогает."""
+    return {name for name, spec in SOURCES.items() if not (spec.get("file") or spec["root"]).exists()}
+
+
+def live_ids(manifest: dict, skip: set[str] = frozenset()) -> tuple[set[str], set[str]]:
+    """
+    Что должно быть в коллекции по текущим файлам: (id чанков, id документов).
+    Для файлов из манифеста известны точные id чанков; файлы вне манифеста
+    парсятся, и их документ сохраняется целиком (все __cN). skip — источники,
+    которые не обходятся.
+    """
+    chunks, docs = set(), set()
+    for name, spec in SOURCES.items():
+        if name in skip:
+            continue
+        paths = [CORPUS_FILE] if "index" in spec else source_files(name)
+        for path in paths:
+            entry = manifest.get(manifest_key(path))
+            if entry and entry["strategy"] != "adopted":
+                chunks.update(entry["ids"])
+            elif path == CORPUS_FILE:
+                docs.update(e["id"] for e in parse_corpus_annotations(path))
+            else:
+                doc = spec["prepare"](path, path.read_text(encoding="utf-8"))
+                if doc:
+                    docs.add(doc["id"])
+    return chunks, docs
+
+
+def gc(collection, verbose=True, dry_run=False) -> int:
+    """
+    Удаляет из коллекции чанки, которым не соответствует ни один текущий
+    файл: удалённые посты, переименованные стихи, лишние __cN после
+    перечанкинга. Чистит манифест от исчезнувших файлов.
+
+    Источник без папки (не выкачан, перенесён) пропускается, как и при
+    индексации: его чанки и записи манифеста остаются. dry_run — только
+    список того, что было бы удалено.
+    """
+    manifest = load_manifest(collection)
+    skip     = missing_sources()
+    gone     = [k for k in manifest if not (REPO_ROOT / k).exists() and source_of(k) not in skip]
+    for k in gone:
+        del manifest[k]
+
+    chunks, docs = live_ids(manifest, skip)
+    candidates = [
+        i for i in iter_collection_ids(collection)
+        if i not in chunks and i.split("__c")[0] not in docs
+    ]
+
+    orphans, kept, reclaimed = [], 0, 0
+    by_source: dict[str, list[str]] = {}
+    disk_before = dir_size(CHROMA_DIR)
+    for start in range(0, len(candidates), GC_BATCH):
+        res   = collection.get(ids=candidates[start:start + GC_BATCH],
+                               include=["documents", "metadatas", "embeddings"])
+        batch = []
+        for i, doc, meta, vec in zip(res["ids"], res["documents"], res["metadatas"], res["embeddings"]):
+            source = (meta or {}).get("source", "?")
+            if source in skip:
+                kept += 1
+                continue
+            batch.append(i)
+            by_source.setdefault(source, []).append(i)
+            reclaimed += len(vec) * 4 + len((doc or "").encode("utf-8"))
+            reclaimed += len(json.dumps(meta or {}, ensure_ascii=False).encode("utf-8"))
+        orphans.extend(batch)
+        if batch and not dry_run:
+            collection.delete(ids=batch)
+            if LEXICAL is not None:
+                LEXICAL.delete(batch)
+    if not dry_run:
+        save_manifest(manifest, collection)
 
     if verbose:
-        print(f"\nTelegram: добавлено {total_added}. Итого в базе: {collection.count()}")
+        if skip:
+            print(f"GC: нет папок источников {', '.join(sorted(skip))} — их {kept} чанков не трогаем")
+        if dry_run:
+            print(f"GC (--dry-run): к удалению векторов {len(orphans)} "
+                  f"(~{reclaimed / 1024:.0f} КБ данных), файлов из манифеста {len(gone)}")
+            for source, ids in sorted(by_source.items()):
+                print(f"  {source}: {len(ids)}")
+                for i in ids[:GC_DRY_RUN_SHOW]:
+                    print(f"    {i}")
+                if len(ids) > GC_DRY_RUN_SHOW:
+                    print(f"    … ещё {len(ids) - GC_DRY_RUN_SHOW}")
+            return len(orphans)
+        print(f"GC: удалено векторов {len(orphans)} (~{reclaimed / 1024:.0f} КБ данных), "
+              f"файлов из манифеста {len(gone)}")
+        print(f"  chroma/ на диске: {disk_before / 2**20:.1f} → {dir_size(CHROMA_DIR) / 2**20:.1f} МБ")
+        print(f"  Итого в базе: {collection.count()}")
+    return len(orphans)
+
+
+def chunk_size_report(manifest: dict) -> list[str]:
+    """Распределение размеров чанков (в токенах) по данным манифеста."""
+    sizes = sorted(t for e in manifest.values() for t in e.get("tokens", []))
+    if not sizes:
+        return []
+    q = statistics.quantiles(sizes, n=10) if len(sizes) > 1 else [sizes[0]] * 9
+    lines = [
+        f"Размер чанков, токенов ({len(sizes)} с данными, {chunker_signature()}):",
+        f"  min {sizes[0]}, p10 {q[0]:.0f}, p50 {q[4]:.0f}, p90 {q[8]:.0f}, "
+        f"max {sizes[-1]}, среднее {statistics.fmean(sizes):.0f}",
+    ]
+    lo = 0
+    for hi in sorted({32, 64, 128, 256, CHUNK_TOKENS}) + [None]:
+        n = sum(1 for t in sizes if t > lo and (hi is None or t <= hi))
+        if n:
+            label = f"{lo + 1}–{hi}" if hi else f">{lo}"
+            lines.append(f"  {label:>9}: {n:6d} {'█' * max(1, round(40 * n / len(sizes)))}")
+        lo = hi or lo
+    return lines
+
+
+def source_of(key: str) -> str | None:
+    """Источник по ключу манифеста (пути относительно репо)."""
+    for name, spec in SOURCES.items():
+        prefix = manifest_key(spec.get("file") or spec["root"])
+        if key == prefix or key.startswith(prefix + "/"):
+            return name
+    return None
 
 
 def stats(collection):
-    count = collection.count()
+    """
+    Сводка по манифесту — он обновляется при каждой записи и хранит id и
+    стратегии чанков каждого файла, так что метаданные из Chroma не читаются.
+    С коллекцией сверяется только общий count().
+    """
+    count    = collection.count()
+    manifest = load_manifest(collection)
+    rows: dict[str, dict] = {}
+    per_doc: list[int]    = []
+    for key, entry in manifest.items():
+        ids = entry.get("ids", [])
+        if not ids:
+            continue
+        row = rows.setdefault(source_of(key) or "?", {"docs": 0, "chunks": 0, "strategies": {}})
+        if "entries" in entry:   # корпус: запись = документ из одного чанка
+            row["docs"] += len(entry["entries"])
+            per_doc.extend([1] * len(entry["entries"]))
+        else:
+            row["docs"] += 1
+            per_doc.append(len(ids))
+        row["chunks"] += len(ids)
+        # записи манифеста до появления strategies — целиком по общей стратегии
+        for strategy, n in (entry.get("strategies") or {entry.get("strategy") or "—": len(ids)}).items():
+            row["strategies"][strategy] = row["strategies"].get(strategy, 0) + n
+
+    total = sum(r["chunks"] for r in rows.values())
     print(f"Записей в базе: {count}")
-    if count > 0:
-        # По источникам
-        for src in ("corpus", "lj", "poetry"):
-            res = collection.get(where={"source": src}, include=["metadatas"])
-            print(f"  {src}: {len(res['ids'])}")
+    if total != count:
+        print(f"  по манифесту {total} — расхождение {count - total:+d} (см. --gc)")
+
+    names      = [n for n in [*SOURCES, "?"] if n in rows]
+    strategies = sorted({st for r in rows.values() for st in r["strategies"]})
+    if names:
+        print(f"  {'источник':<17}{'докум.':>8}{'чанков':>8}" + "".join(f"{st:>12}" for st in strategies))
+        for name in names:
+            r = rows[name]
+            print(f"  {name:<17}{r['docs']:>8}{r['chunks']:>8}"
+                  + "".join(f"{r['strategies'].get(st, 0):>12}" for st in strategies))
+
+    if per_doc:
+        buckets = [("1", 1, 1), ("2–3", 2, 3), ("4–7", 4, 7), ("8+", 8, None)]
+        print("Чанков на документ: " + ", ".join(
+            f"{label} — {sum(1 for n in per_doc if n >= lo and (hi is None or n <= hi))}"
+            for label, lo, hi in buckets
+        ))
+    print(f"Chroma на диске: {dir_size(CHROMA_DIR) / 2**20:.1f} МБ")
+    if LEXICAL is not None:
+        lexical_count = LEXICAL.count()
+        drift         = f" — расхождение {lexical_count - count:+d}" if lexical_count != count else ""
+        print(f"Лексический индекс: {lexical_count} чанков{drift}")
+    for line in chunk_size_report(manifest):
+        print(line)
+
+
+def recall_report(collection, dims=(256, 512, 1024, 1536), queries=200, k=10):
+    """
+    Сколько теряет поиск при уменьшении размерности. Векторы полноразмерной
+    коллекции укорачиваются локально (shorten) — без запросов к API;
+    запросами служат случайные чанки самой коллекции. recall@k — доля
+    top-k полноразмерного поиска, найденная в укороченном.
+    """
+    import numpy as np   # есть всегда вместе с chromadb
+
+    vectors, offset = [], 0
+    while True:
+        res = collection.get(include=["embeddings"], limit=ID_PAGE, offset=offset)
+        vectors.extend(res["embeddings"])
+        if len(res["ids"]) < ID_PAGE:
+            break
+        offset += ID_PAGE
+    if len(vectors) <= k:
+        print("Слишком мало векторов для оценки")
+        return
+
+    full = np.asarray(vectors, dtype=np.float32)
+    rng  = np.random.default_rng(0)
+    qidx = rng.choice(len(full), size=min(queries, len(full)), replace=False)
+
+    def top_k(matrix):
+        matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        scores = matrix[qidx] @ matrix.T
+        scores[np.arange(len(qidx)), qidx] = -np.inf     # сам чанк не считаем
+        return np.argpartition(-scores, k, axis=1)[:, :k]
+
+    reference = top_k(full)
+    n, native = full.shape
+    print(f"recall@{k} относительно {native} измерений ({n} векторов, {len(qidx)} запросов):")
+    print(f"  {native:5d}: 1.000, векторы {n * native * 4 / 2**20:7.1f} МБ")
+    for d in dims:
+        if d >= native:
+            continue
+        found  = top_k(full[:, :d])
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(reference, found)])
+        print(f"  {d:5d}: {recall:.3f}, векторы {n * d * 4 / 2**20:7.1f} МБ")
 
 
-def search(query: str, oai: OpenAI, collection, n=5, source: str = None):
-    vector  = embed([query], oai)[0]
+def search(query: str, collection, n=5, source: str = None, **where_args):
+    """where_args — date_from, date_to, author, tags; см. filters.build_where."""
+    where   = filters.build_where(source, **where_args)
+    vector  = embed([query], query=True)[0]
     kwargs  = dict(
         query_embeddings=[vector],
         n_results=n,
         include=["documents", "metadatas", "distances"],
     )
-    if source:
-        kwargs["where"] = {"source": source}
+    if where:
+        kwargs["where"] = where
     results = collection.query(**kwargs)
-    src_label = f" [{source}]" if source else ""
+    labels  = [source or "", *(f"{k}={v}" for k, v in where_args.items() if v)]
+    src_label = f" [{', '.join(filter(None, labels))}]" if any(labels) else ""
     print(f"\nПоиск{src_label}: «{query}»\n")
     for doc, meta, dist in zip(
         results["documents"][0],
@@ -506,29 +2380,109 @@ def search(query: str, oai: OpenAI, collection, n=5, source: str = None):
         print()
 
 
+# ── CLI ───────────────────────────────────────────────────────────────────────
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--source", choices=["corpus", "lj", "poetry", "telegram"], default=None)
-    parser.add_argument("--limit",  type=int, default=0, help="Лимит постов ЖЖ (0 = все)")
+    parser.add_argument("--source", choices=[*SOURCES, "all"], default=None,
+                        help="Источник для индексации (all — все по очереди); по умолчанию corpus")
+    parser.add_argument("--limit",  type=int, default=0, help="Лимит файлов на источник (0 = все)")
     parser.add_argument("--n",      type=int, default=5, help="Количество результатов поиска")
     parser.add_argument("--stats",  action="store_true")
+    parser.add_argument("--gc",     action="store_true",
+                        help="Удалить из коллекции чанки удалённых/изменённых файлов")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="С --gc: только показать, какие чанки были бы удалены")
     parser.add_argument("--search", metavar="QUERY")
+    parser.add_argument("--date-from", help="--search: не раньше (ГГГГ, ГГГГ-ММ, ГГГГ-ММ-ДД)")
+    parser.add_argument("--date-to",   help="--search: не позже, период включительно")
+    parser.add_argument("--author",    help="--search: автор (стихи), точное совпадение")
+    parser.add_argument("--tags",      help="--search: теги через запятую — хотя бы один")
+    parser.add_argument("--watch",  action="store_true",
+                        help="Следить за файлами источников (--source, по умолчанию все) и индексировать правки")
+    parser.add_argument("--plan",   action="store_true",
+                        help="Оценить прогон (--source): чанки, вызовы, токены, стоимость, время — без API")
+    parser.add_argument("--batch-items",  type=int, default=EMBED_BATCH_ITEMS,
+                        help="Максимум чанков в одном запросе к embeddings")
+    parser.add_argument("--batch-tokens", type=int, default=EMBED_BATCH_TOKENS,
+                        help="Максимум (оценочных) токенов в одном запросе к embeddings")
+    parser.add_argument("--workers", type=int, default=ANNOTATE_WORKERS,
+                        help="Параллельных запросов аннотаций")
+    parser.add_argument("--rpm", type=int, default=ANNOTATE_RPM,
+                        help="Лимит аннотаций в минуту (0 = без лимита)")
+    parser.add_argument("--tpm", type=int, default=ANNOTATE_TPM,
+                        help="Лимит токенов аннотаций в минуту (0 = без лимита)")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS,
+                        help="Бюджет чанка в токенах; смена — перечанкивание файлов")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP,
+                        help="Перекрытие соседних чанков в токенах")
+    parser.add_argument("--embedder", default=EMBEDDER_SPEC,
+                        help="Эмбеддер «backend:model»: openai:…, local:…, hash; своя коллекция")
+    parser.add_argument("--dimensions", type=int, default=EMBED_DIMENSIONS,
+                        help="Размерность эмбеддингов (0 = родная); своя коллекция и манифест")
+    parser.add_argument("--compact", action="store_true",
+                        help="Хранить векторы в кэше эмбеддингов как float16")
+    parser.add_argument("--recall", action="store_true",
+                        help="Оценить recall@10 при уменьшенной размерности")
+    parser.add_argument("--prometheus", type=Path, metavar="FILE",
+                        help="Писать метрики прогона ещё и в Prometheus text format")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Не использовать дисковые кэши эмбеддингов и аннотаций")
+    parser.add_argument("--annotation-cache", choices=["list", "prune"],
+                        help="Версии промпта в кэше аннотаций / удалить устаревшие")
     args = parser.parse_args()
-
-    api_key    = load_api_key()
-    oai_client = OpenAI(api_key=api_key)
+    try:   # даты фильтра — до открытия базы и запросов к API
+        filters.build_where(date_from=args.date_from, date_to=args.date_to)
+    except ValueError as e:
+        parser.error(str(e))
+
+    EMBED_BATCH_ITEMS  = args.batch_items
+    EMBED_BATCH_TOKENS = args.batch_tokens
+    ANNOTATE_WORKERS   = max(1, args.workers)
+    CHUNK_TOKENS       = args.chunk_tokens
+    EMBEDDER_SPEC      = args.embedder
+    METRICS_PROM_FILE  = args.prometheus
+    EMBED_DIMENSIONS   = args.dimensions
+    EMBED_CACHE_DTYPE  = "e" if args.compact else "f"
+    CHUNK_OVERLAP      = min(args.chunk_overlap, CHUNK_TOKENS // 2)
+    ANNOTATE_LIMITER   = RateLimiter(args.rpm, args.tpm)
+    if not args.no_cache:
+        EMBED_CACHE      = EmbedCache(EMBED_CACHE_FILE)
+        ANNOTATION_CACHE = AnnotationCache(ANNOTATION_CACHE_FILE)
+
+    if args.annotation_cache:
+        annotation_cache_command(args.annotation_cache)
+        sys.exit(0)
+
+    # без ключа локальный эмбеддер работает офлайн; аннотации — только из кэша
+    oai_client = openai_client() if CONFIG_FILE.exists() else None
+    EMBEDDER   = make_embedder(EMBEDDER_SPEC, EMBED_DIMENSIONS, lambda: oai_client or openai_client())
+    if args.plan:
+        print_plan(list(SOURCES) if args.source == "all" else [args.source or "corpus"], args.limit)
+        sys.exit(0)
     chroma     = chromadb.PersistentClient(path=str(CHROMA_DIR))
     col        = get_collection(chroma)
+    LEXICAL    = LexicalIndex(lexical.index_path(col.name))
+    sync_lexical(col)
 
     if args.stats:
         stats(col)
+    elif args.gc:
+        gc(col, dry_run=args.dry_run)
+    elif args.recall:
+        recall_report(col)
     elif args.search:
-        search(args.search, oai_client, col, n=args.n, source=args.source)
-    elif args.source == "lj":
-        index_lj(oai_client, col, limit=args.limit)
-    elif args.source == "poetry":
-        index_poetry(oai_client, col)
-    elif args.source == "telegram":
-        index_telegram(oai_client, col)
+        source = None if args.source == "all" else args.source
+        search(args.search, col, n=args.n, source=source, date_from=args.date_from,
+               date_to=args.date_to, author=args.author, tags=args.tags)
+    elif args.watch:
+        watch(list(SOURCES) if args.source in (None, "all") else [args.source], oai_client, col)
+    elif args.source == "all":
+        index_sources(list(SOURCES), oai_client, col, limit=args.limit)
     else:
-        index_corpus(oai_client, col)
+        index_sources([args.source or "corpus"], oai_client, col, limit=args.limit)
+
+    if EMBED_CACHE is not None and EMBED_CACHE.hits + EMBED_CACHE.misses:
+        print(f"  ({EMBED_CACHE.summary()})")
+    if ANNOTATION_CACHE is not None and ANNOTATION_CACHE.hits + ANNOTATION_CACHE.misses:
+        print(f"  ({ANNOTATION_CACHE.summary()})")
@@ -0,0 +1,71 @@
+"""
+Общее для indexer.py и mcp_search.py: где что лежит. Пути конфигурации
+и базы, имена коллекций и манифестов, список источников — в одном месте,
+чтобы индексатор и поисковый сервер не разошлись в правилах именования.
+
+Индексатор читает отсюда названия источников и дополняет их своими
+обработчиками (SOURCES в indexer.py); сервер строит из них схему source.
+"""
+
+import json
+from pathlib import Path
+
+import embedders
+
+CONFIG_DIR      = Path.home() / ".config/clody_spark"
+CONFIG_FILE     = CONFIG_DIR / "openai.json"
+CHROMA_DIR      = CONFIG_DIR / "chroma"
+MANIFEST_FILE   = CONFIG_DIR / "index_manifest.json"
+REPO_ROOT       = Path(__file__).parent.parent
+COLLECTION_NAME = "clody_spark"
+
+MANIFEST_COLLECTION = "__collection__"   # ключ манифеста: id коллекции, которую он описывает
+
+# источник → название; порядок — порядок обхода в --source all
+SOURCE_TITLES = {
+    "corpus":           "Корпус",
+    "lj":               "ЖЖ",
+    "poetry":           "Поэзия",
+    "telegram":         "Telegram",
+    "journal":          "Дневник",
+    "daughter_journal": "Дневник дочери",
+    "texts":            "Эссе",
+}
+
+
+def load_api_key() -> str:
+    with open(CONFIG_FILE, encoding="utf-8") as f:
+        return json.load(f)["api_key"]
+
+
+def collection_name(spec: str, dimensions: int = 0) -> str:
+    """
+    У каждого эмбеддера и размерности своя коллекция: clody_spark,
+    clody_spark_d512, clody_spark_local_intfloat-multilingual-e5-small…
+    """
+    return embedders.collection_name(COLLECTION_NAME, spec, dimensions)
+
+
+def manifest_file(collection: str) -> Path:
+    """У каждой коллекции свой манифест: суффикс — хвост её имени."""
+    suffix = collection.removeprefix(COLLECTION_NAME)   # "", "_d512", "_hash"…
+    return MANIFEST_FILE.with_name(f"{MANIFEST_FILE.stem}{suffix}.json")
+
+
+def read_manifest(path: Path) -> tuple[str | None, dict]:
+    """(id коллекции, записи по файлам); нет файла или он битый — (None, {})."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+    return manifest.pop(MANIFEST_COLLECTION, None), manifest
+
+
+def collection_dimensions(collection) -> int | None:
+    """Размерность векторов коллекции: из метаданных или по первому вектору."""
+    dims = (collection.metadata or {}).get("embed_dimensions")
+    if dims is None and collection.count():
+        res  = collection.get(limit=1, include=["embeddings"])
+        dims = len(res["embeddings"][0])
+    return dims
@@ -0,0 +1,282 @@
+"""
+Лексический индекс для indexer.py и mcp_search.py: BM25 по тем же чанкам,
+что лежат в коллекции Chroma. Ловит то, что векторный поиск упускает, —
+имена, редкие слова, цитаты, теги ЖЖ, термины из texts/.
+
+Токены:
+    русские слова   → стемминг Snowball (порт алгоритма, без зависимостей)
+    латиница, цифры → как есть, в нижнем регистре
+    CJK (китайский в corpus-annotations) → биграммы иероглифов
+
+Индекс — SQLite рядом с базой Chroma, свой файл на каждую коллекцию
+(см. index_path). Поиск — миллисекунды и без API, поэтому он же служит
+запасным, когда эмбеддинги недоступны. Гибридная выдача — слияние рангов
+(reciprocal rank fusion, см. rrf).
+"""
+
+import re
+import math
+import sqlite3
+import threading
+from pathlib import Path
+
+LEXICAL_DIR = Path.home() / ".config/clody_spark/lexical"
+TOKENIZER   = "ru-snowball-cjk2-v1"   # смена токенизатора — пересборка индекса
+
+BM25_K1 = 1.2
+BM25_B  = 0.75
+RRF_K   = 60    # сглаживание в 1 / (k + rank); 60 — значение из статьи о RRF
+
+CJK_RE   = r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]"
+TOKEN_RE = re.compile(rf"({CJK_RE}+)|[^\W_]+")
+
+STOPWORDS = frozenset("""
+    и в во не что он на я с со как а то все она так его но да ты к у же вы за бы
+    по только ее мне было вот от меня еще нет о из ему когда даже ну ли если уже
+    или ни быть был него до вас вам ведь там потом себя ей они тут где есть ней
+    для мы тебя их чем была сам без чего раз тоже себе под будет ж тогда кто этот
+    того потому этого какой ним здесь этом мой тем чтобы нее были при об тот эти
+    нас про всего них эту моя этой перед это
+    the a an and or of to in is it that for on with as at by be this are was
+""".split())
+
+
+def index_path(collection: str) -> Path:
+    """Файл индекса коллекции: у каждого эмбеддера своя коллекция и свой индекс."""
+    return LEXICAL_DIR / f"{collection}.sqlite"
+
+
+# ── Стемминг ──────────────────────────────────────────────────────────────────
+# Snowball Russian: https://snowballstem.org/algorithms/russian/stemmer.html
+# Окончания группы 1 снимаются, только если перед ними «а» или «я».
+
+VOWELS = set("аеиоуыэюя")
+
+
+def _endings(words: str) -> tuple[str, ...]:
+    return tuple(sorted(words.split(), key=len, reverse=True))
+
+
+PERFECTIVE_GERUND = (_endings("в вши вшись"), _endings("ив ивши ившись ыв ывши ывшись"))
+ADJECTIVE         = ((), _endings("ее ие ые ое ими ыми ей ий ый ой ем им ым ом его ого ему ому "
+                                  "их ых ую юю ая яя ою ею"))
+PARTICIPLE        = (_endings("ем нн вш ющ щ"), _endings("ивш ывш ующ"))
+REFLEXIVE         = ((), _endings("ся сь"))
+VERB              = (_endings("ла на ете йте ли й л ем н ло но ет ют ны ть ешь нно"),
+                     _endings("ила ыла ена ейте уйте ите или ыли ей уй ил ыл им ым ен ило "
+                              "ыло ено ят ует уют ит ыт ены ить ыть ишь ую ю"))
+NOUN              = ((), _endings("а ев ов ие ье е иями ями ами еи ии и ией ей ой ий й иям ям "
+                                  "ием ем ам ом о у ах иях ях ы ь ию ью ю ия ья я"))
+SUPERLATIVE       = ((), _endings("ейше ейш"))
+DERIVATIONAL      = ((), _endings("ость ост"))
+
+
+def _strip(rv: str, groups: tuple) -> str | None:
+    """Снимает самое длинное подходящее окончание; None — ничего не подошло."""
+    best = ""
+    for after_a, endings in ((True, groups[0]), (False, groups[1])):
+        for e in endings:
+            if len(e) <= len(best):
+                break
+            if rv.endswith(e) and (not after_a or rv[:-len(e)][-1:] in ("а", "я")):
+                best = e
+                break
+    return rv[:-len(best)] if best else None
+
+
+def _regions(word: str) -> tuple[int, int]:
+    """Начало RV (после первой гласной) и R2 (R1 от R1)."""
+    rv = next((i + 1 for i, ch in enumerate(word) if ch in VOWELS), len(word))
+    r1 = r2 = len(word)
+    for i in range(1, len(word)):
+        if word[i] not in VOWELS and word[i - 1] in VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i] not in VOWELS and word[i - 1] in VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def stem_ru(word: str) -> str:
+    rv_start, r2_start = _regions(word)
+    head, rv = word[:rv_start], word[rv_start:]
+
+    # шаг 1: деепричастие, иначе возвратность + прилагательное/глагол/существительное
+    stripped = _strip(rv, PERFECTIVE_GERUND)
+    if stripped is not None:
+        rv = stripped
+    else:
+        reflexive = _strip(rv, REFLEXIVE)
+        if reflexive is not None:
+            rv = reflexive
+        adjective = _strip(rv, ADJECTIVE)
+        if adjective is not None:
+            participle = _strip(adjective, PARTICIPLE)
+            rv         = adjective if participle is None else participle
+        else:
+            rv = next((s for s in (_strip(rv, VERB), _strip(rv, NOUN)) if s is not None), rv)
+
+    # шаг 2
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    # шаг 3: словообразовательный суффикс в R2
+    r2 = (head + rv)[r2_start:]
+    derivational = _strip(r2, DERIVATIONAL)
+    if derivational is not None:
+        rv = rv[:len(rv) - (len(r2) - len(derivational))]
+
+    # шаг 4
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        superlative = _strip(rv, SUPERLATIVE)
+        if superlative is not None:
+            rv = superlative[:-1] if superlative.endswith("нн") else superlative
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+    return head + rv
+
+
+def tokenize(text: str) -> list[str]:
+    """Термы для индекса и запроса — одна функция для обеих сторон."""
+    terms = []
+    for m in TOKEN_RE.finditer(text.lower().replace("ё", "е")):
+        cjk = m.group(1)
+        if cjk:
+            terms.extend(cjk[i:i + 2] for i in range(max(1, len(cjk) - 1)))
+            continue
+        word = m.group(0)
+        if word in STOPWORDS:
+            continue
+        terms.append(stem_ru(word) if "а" <= word[0] <= "я" else word)
+    return terms
+
+
+def doc_text(text: str, meta: dict) -> str:
+    """Что индексируется для чанка: заголовок, теги, автор и сам текст."""
+    fields = [meta.get(k, "") for k in ("title", "tags", "author")]
+    return "\n".join([*filter(None, fields), text])
+
+
+# ── Индекс ────────────────────────────────────────────────────────────────────
+
+class LexicalIndex:
+    """
+    Инвертированный индекс в SQLite: postings(term, id, tf) и длины чанков.
+    id — те же, что в Chroma; replace/delete вызываются там же, где пишется
+    коллекция. IDF и средняя длина считаются при запросе.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db   = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, source TEXT, length INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT, id TEXT, tf INTEGER,"
+            " PRIMARY KEY (term, id)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self.db.commit()
+
+    @property
+    def tokenizer(self) -> str | None:
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+        return row[0] if row else None
+
+    @property
+    def collection(self) -> str | None:
+        """id коллекции Chroma, по которой построен индекс (None — до этой отметки)."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'collection'").fetchone()
+        return row[0] if row else None
+
+    def set_collection(self, collection_id: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('collection', ?)", (collection_id,))
+            self.db.commit()
+
+    def ids(self) -> set[str]:
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM docs")}
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _delete(self, ids: list[str]):
+        for start in range(0, len(ids), 500):
+            part  = ids[start:start + 500]
+            marks = ",".join("?" * len(part))
+            self.db.execute(f"DELETE FROM postings WHERE id IN ({marks})", part)
+            self.db.execute(f"DELETE FROM docs WHERE id IN ({marks})", part)
+
+    def replace(self, docs: list[tuple[str, str, str]], remove: list[str] = ()):
+        """docs — [(id, текст, source)]: заменяет их термы; remove — удалить чанки."""
+        with self.lock:
+            self._delete([d[0] for d in docs] + list(remove))
+            postings, lengths = [], []
+            for doc_id, text, source in docs:
+                terms = tokenize(text)
+                tf: dict[str, int] = {}
+                for t in terms:
+                    tf[t] = tf.get(t, 0) + 1
+                postings.extend((t, doc_id, n) for t, n in tf.items())
+                lengths.append((doc_id, source, len(terms)))
+            self.db.executemany("INSERT INTO docs VALUES (?, ?, ?)", lengths)
+            self.db.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (TOKENIZER,))
+            self.db.commit()
+
+    def delete(self, ids: list[str]):
+        with self.lock:
+            self._delete(list(ids))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM postings")
+            self.db.execute("DELETE FROM docs")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (TOKENIZER,))
+            self.db.commit()
+
+    def search(self, query: str, n: int = 10, source: str | None = None) -> list[tuple[str, float]]:
+        """[(id, BM25)] по убыванию; df и длины — по всему индексу, source только фильтрует."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        scores: dict[str, float] = {}
+        with self.lock:
+            total, avgdl = self.db.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+            if not total:
+                return []
+            for term in terms:
+                rows = self.db.execute(
+                    "SELECT p.id, p.tf, d.length, d.source FROM postings p"
+                    " JOIN docs d ON d.id = p.id WHERE p.term = ?",
+                    (term,),
+                ).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+                for doc_id, tf, length, doc_source in rows:
+                    if source and doc_source != source:
+                        continue
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (avgdl or 1))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return sorted(scores.items(), key=lambda kv: -kv[1])[:n]
+
+
+def rrf(*rankings: list[str], k: int = RRF_K) -> list[tuple[str, float]]:
+    """Reciprocal rank fusion: сумма 1 / (k + ранг) по спискам id; [(id, вес)] по убыванию."""
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: -kv[1])
@@ -4,72 +4,786 @@ MCP-сервер: search_corpus — семантический поиск по 
 
 Запуск (Claude Code добавит автоматически через settings):
     python scripts/mcp_search.py
+
+Эмбеддер — переменная окружения CLODY_EMBEDDER («backend:model», см.
+embedders.py; по умолчанию openai:text-embedding-3-large), размерность —
+CLODY_EMBED_DIMENSIONS (по умолчанию родная для модели). Должны совпадать
+с --embedder и --dimensions, с которыми индекс построен indexer.py; иначе
+поиск вернёт ошибку. С local-эмбеддером запрос не ходит в сеть: модель
+грузится один раз при первом поиске.
+
+Клиенты долгоживущие: OpenAI (с пулом HTTP-соединений) и Chroma с
+загруженным HNSW-индексом создаются при первом запросе и переиспользуются.
+Коллекция переоткрывается, только когда indexer.py изменил базу на диске.
+
+Поиск гибридный: векторная выдача сливается с лексической (BM25 по
+индексу, который ведёт indexer.py, см. lexical.py) через reciprocal rank
+fusion. Если эмбеддинги недоступны (нет сети, ключа, API отвечает
+ошибкой), выдача целиком лексическая — без API и за миллисекунды.
+Запрос к API ждёт не дольше CLODY_EMBED_TIMEOUT_S (5 с) без повторов, после
+сбоя hybrid CLODY_EMBED_COOLDOWN_S (30 с) сразу идёт лексическим путём.
+
+Запросы обрабатываются конкурентно: tools/call уходят в пул из
+CLODY_MCP_WORKERS потоков (по умолчанию 4), ответы пишутся по мере
+готовности с исходным id; notifications/cancelled снимает запрос.
+
+group_by=document схлопывает чанки длинных постов (doc__c0…__cN) в один
+документ: чанков берётся с запасом, оценка документа — max/sum/mean по его
+чанкам, в выдаче — лучшие чанки; full_text подгружает текст с диска только
+для вернувшихся документов (путь — из манифеста indexer.py).
+
+Фильтры date_from / date_to, author и tags (см. filters.py) уходят в where
+Chroma вместе с source: векторный поиск идёт только по подходящим чанкам,
+лексические кандидаты сверяются с тем же where.
+
+Одновременные запросы склеиваются: эмбеддинги всех поисков, пришедших в
+окне CLODY_EMBED_WINDOW_MS (по умолчанию 5 мс, 0 — выключить), уходят
+одним вызовом, не больше CLODY_EMBED_MAX_BATCH текстов (см. QueryBatcher).
+Одиночный запрос, когда других в работе нет, окна не ждёт.
+
+Векторы запросов кэшируются на диске (query_cache.sqlite, LRU на
+CLODY_QUERY_CACHE_MAX записей, 0 — выключить): повторный запрос не ходит
+в сеть. Попадания и промахи — в инструменте diagnostics.
 """
 
+import os
+import re
 import json
 import sys
+import asyncio
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import chromadb
+import openai
 from openai import OpenAI
 
-CONFIG_FILE     = Path.home() / ".config/clody_spark/openai.json"
-CHROMA_DIR      = Path.home() / ".config/clody_spark/chroma"
-COLLECTION_NAME = "clody_spark"
+try:
+    from chromadb.errors import NotFoundError
+except ImportError:   # старые версии chromadb
+    NotFoundError = ValueError
+
+from embedders import DEFAULT_EMBEDDER, make_embedder
+from layout import (
+    CONFIG_DIR, CHROMA_DIR, REPO_ROOT, SOURCE_TITLES,
+    load_api_key, collection_dimensions, read_manifest,
+)
+from lexical import LexicalIndex
+import filters
+import layout
+import lexical
+
+QUERY_CACHE_FILE = CONFIG_DIR / "query_cache.sqlite"
+
+EMBEDDER_SPEC    = os.environ.get("CLODY_EMBEDDER", DEFAULT_EMBEDDER)
+EMBED_DIMENSIONS = int(os.environ.get("CLODY_EMBED_DIMENSIONS", "0"))
+QUERY_CACHE_MAX  = int(os.environ.get("CLODY_QUERY_CACHE_MAX", "20000"))
+MCP_WORKERS      = int(os.environ.get("CLODY_MCP_WORKERS", "4"))
+EMBED_WINDOW     = float(os.environ.get("CLODY_EMBED_WINDOW_MS", "5")) / 1000
+EMBED_MAX_BATCH  = int(os.environ.get("CLODY_EMBED_MAX_BATCH", "32"))
+EMBED_TIMEOUT    = float(os.environ.get("CLODY_EMBED_TIMEOUT_S", "5"))
+EMBED_COOLDOWN   = float(os.environ.get("CLODY_EMBED_COOLDOWN_S", "30"))
 
-REPO_ROOT = Path(__file__).parent.parent
+SEARCH_MODES      = ("hybrid", "vector", "lexical")
+FUSION_DEPTH      = 4    # каждая сторона гибрида отдаёт n × FUSION_DEPTH кандидатов (не меньше 20)
+BATCH_MAX_QUERIES = 16   # запросов в одном search_corpus_batch
+DOC_OVERFETCH     = 5    # group_by=document: чанков на n × DOC_OVERFETCH
+DOC_CHUNKS        = 3    # лучших чанков в выдаче на документ
+DOC_TEXT_MAX      = 20000   # символов полного текста на документ
+FILTER_KEYS       = ("date_from", "date_to", "author", "tags")
+FILTER_OVERFETCH  = 10   # с фильтрами лексических кандидатов берём с запасом — часть отсеется
 
+AGGREGATES = {
+    "max":  max,                               # лучший чанк
+    "sum":  sum,                               # чем больше совпавших чанков, тем выше
+    "mean": lambda scores: sum(scores) / len(scores),
+}
 
-def load_api_key():
-    with open(CONFIG_FILE) as f:
-        return json.load(f)["api_key"]
+STARTED = time.time()
 
 
-def get_collection():
+def collection_name() -> str:
+    """Коллекция под эмбеддер и размерность — схема имён общая с indexer.py (layout.py)."""
+    return layout.collection_name(EMBEDDER_SPEC, EMBED_DIMENSIONS)
+
+
+def open_collection():
+    name   = collection_name()
     client = chromadb.PersistentClient(path=str(CHROMA_DIR))
     return client.get_or_create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}
+        name=name,
+        metadata={"hnsw:space": "cosine", "embedder": EMBEDDER_SPEC}
     )
 
 
-def search_corpus(query: str, n: int = 5, source: str | None = None) -> list[dict]:
-    api_key = load_api_key()
-    oai     = OpenAI(api_key=api_key)
+def chroma_stamp() -> tuple:
+    """
+    Отпечаток базы на диске: mtime chroma.sqlite3 и его WAL. Любая запись
+    indexer.py (add/upsert/delete, пересоздание коллекции) его меняет.
+    """
+    stamp = []
+    for name in ("chroma.sqlite3", "chroma.sqlite3-wal"):
+        try:
+            st = (CHROMA_DIR / name).stat()
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def check_collection(collection):
+    """Индекс должен быть построен тем же эмбеддером и той же размерностью."""
+    built = (collection.metadata or {}).get("embedder", DEFAULT_EMBEDDER)
+    if built != EMBEDDER_SPEC:
+        raise RuntimeError(
+            f"Индекс {collection.name} построен эмбеддером {built}, запрос — {EMBEDDER_SPEC}. "
+            f"Проверьте CLODY_EMBEDDER."
+        )
+    dims = collection_dimensions(collection)
+    want = get_embedder().dimensions
+    if dims is not None and want and dims != want:
+        raise RuntimeError(
+            f"Индекс {collection.name} построен с размерностью {dims}, запрос — {want}. "
+            f"Проверьте CLODY_EMBED_DIMENSIONS."
+        )
+
+
+# Chroma в процессе кэширует HNSW-индекс и не видит чужих записей, поэтому
+# при смене отпечатка базы системный кэш сбрасывается и клиент открывается заново.
+_collection = None
+_stamp      = None
+_lock       = threading.Lock()
+
+
+def get_collection(reopen: bool = False):
+    global _collection, _stamp
+    with _lock:
+        stamp = chroma_stamp()
+        if _collection is None or reopen or stamp != _stamp:
+            if _collection is not None:
+                chromadb.PersistentClient(path=str(CHROMA_DIR)).clear_system_cache()
+            collection  = open_collection()
+            check_collection(collection)
+            _collection = collection
+            _stamp      = chroma_stamp()   # get_or_create мог сам записать в базу
+        return _collection
+
+
+_embedder  = None
+_init_lock = threading.RLock()   # ленивые синглтоны: эмбеддер, кэш запросов, лексика
+
+
+def get_embedder():
+    """
+    Эмбеддер создаётся один раз на процесс — локальную модель грузить дорого.
+    Клиент OpenAI без повторов и с коротким таймаутом: запрос ждёт человек
+    или агент, и при недоступном API лучше сразу уйти в лексический поиск.
+    """
+    global _embedder
+    with _init_lock:
+        if _embedder is None:
+            _embedder = make_embedder(
+                EMBEDDER_SPEC, EMBED_DIMENSIONS,
+                lambda: OpenAI(api_key=load_api_key(), timeout=EMBED_TIMEOUT, max_retries=0),
+            )
+        return _embedder
+
+
+_embed_down_until = 0.0   # time.monotonic(): до этого момента hybrid не зовёт эмбеддер
+_embed_failures   = 0
+
+
+def embeddings_down() -> bool:
+    return time.monotonic() < _embed_down_until
+
+
+def mark_embeddings(ok: bool):
+    """После сбоя эмбеддер пропускается EMBED_COOLDOWN секунд; успех снимает паузу."""
+    global _embed_down_until, _embed_failures
+    with _init_lock:
+        if ok:
+            _embed_down_until = 0.0
+        else:
+            _embed_down_until = time.monotonic() + EMBED_COOLDOWN
+            _embed_failures  += 1
+
+
+# ── Кэш векторов запросов ─────────────────────────────────────────────────────
+
+def normalize_query(query: str) -> str:
+    """Ключ кэша: регистр, юникод-формы и пробелы на вектор почти не влияют."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip().casefold()
+
+
+class QueryCache:
+    """
+    LRU векторов запросов в SQLite, ключ (model, dimensions, sha256(запроса)).
+    Переживает перезапуск сервера; сверх max_rows вытесняются давно не
+    запрошенные. Векторы — float32, как в кэше эмбеддингов indexer.py.
+    """
+
+    def __init__(self, path: Path, max_rows: int = QUERY_CACHE_MAX):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db       = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock     = threading.Lock()
+        self.max_rows = max_rows
+        self.hits     = 0
+        self.misses   = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS queries ("
+            " model TEXT, dimensions INTEGER, hash TEXT, vector BLOB, used REAL,"
+            " PRIMARY KEY (model, dimensions, hash))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS queries_used ON queries (used)")
+        self.db.commit()
+
+    @staticmethod
+    def key(query: str) -> str:
+        return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+    def get(self, model: str, dimensions: int, query: str) -> list[float] | None:
+        key = self.key(query)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT vector FROM queries WHERE model = ? AND dimensions = ? AND hash = ?",
+                (model, dimensions, key),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute(
+                "UPDATE queries SET used = ? WHERE model = ? AND dimensions = ? AND hash = ?",
+                (time.time(), model, dimensions, key),
+            )
+            self.db.commit()
+        vec = array("f")
+        vec.frombytes(row[0])
+        return vec.tolist()
+
+    def put(self, model: str, dimensions: int, query: str, vector):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO queries (model, dimensions, hash, vector, used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (model, dimensions, self.key(query), array("f", vector).tobytes(), time.time()),
+            )
+            (count,) = self.db.execute("SELECT COUNT(*) FROM queries").fetchone()
+            if count > self.max_rows:
+                self.db.execute(
+                    "DELETE FROM queries WHERE rowid IN"
+                    " (SELECT rowid FROM queries ORDER BY used LIMIT ?)",
+                    (count - self.max_rows,),
+                )
+            self.db.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        with self.lock:
+            (rows,) = self.db.execute("SELECT COUNT(*) FROM queries").fetchone()
+        return {
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "size":      rows,
+            "max_size":  self.max_rows,
+        }
+
+
+_query_cache = None
+
+
+def get_query_cache() -> QueryCache | None:
+    """None — кэш выключен (CLODY_QUERY_CACHE_MAX=0) или эмбеддер не кэшируемый."""
+    global _query_cache
+    if QUERY_CACHE_MAX <= 0 or not get_embedder().cacheable:
+        return None
+    with _init_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache(QUERY_CACHE_FILE)
+        return _query_cache
+
+
+# ── Склейка запросов к эмбеддеру ──────────────────────────────────────────────
+
+class _Batch:
+    def __init__(self):
+        self.texts:   list[str]    = []
+        self.waiters: list[tuple]  = []   # (Future, срез в texts, время постановки)
+        self.full                  = threading.Event()
+
+
+class QueryBatcher:
+    """
+    Микробатчинг запросов к эмбеддеру из потоков диспетчера. Первый
+    пришедший открывает пачку и ждёт window (или пока в ней не наберётся
+    max_batch текстов), остальные за это время дописываются в неё. Затем
+    ведущий отправляет один запрос и раздаёт векторы по Future. Следующий
+    запрос открывает новую пачку, не дожидаясь ответа по предыдущей.
+
+    Ждать есть смысл, только когда эмбеддер уже кто-то ждёт: одиночный
+    запрос (других вызовов embed в работе нет) уходит сразу, без window.
+    Под нагрузкой пачку собирают те, кто пришёл, пока летит предыдущая.
+    """
+
+    def __init__(self, embed, window: float = EMBED_WINDOW, max_batch: int = EMBED_MAX_BATCH):
+        self.embed_fn  = embed
+        self.window    = window
+        self.max_batch = max(1, max_batch)
+        self.lock      = threading.Lock()
+        self.open      = None
+        self.active    = 0   # вызовов embed в работе, от входа до ответа
+        self.calls     = 0   # вызовов embed
+        self.immediate = 0   # пачек, ушедших без ожидания window
+        self.batches   = 0   # запросов к эмбеддеру
+        self.texts     = 0
+        self.sizes     = deque(maxlen=1000)   # вызовов в пачке — последние 1000 пачек
+        self.waits     = deque(maxlen=1000)   # ожидание от постановки до отправки, с
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        if self.window <= 0:
+            with self.lock:
+                self.calls   += 1
+                self.batches += 1
+                self.texts   += len(texts)
+            return self.embed_fn(texts)
+
+        future = Future()
+        with self.lock:
+            self.calls  += 1
+            self.active += 1
+            batch  = self.open
+            leader = batch is None
+            if leader:
+                batch = self.open = _Batch()
+                if self.active == 1:   # никого больше нет — ждать некого
+                    batch.full.set()
+                    self.immediate += 1
+            start = len(batch.texts)
+            batch.texts.extend(texts)
+            batch.waiters.append((future, slice(start, len(batch.texts)), time.monotonic()))
+            if len(batch.texts) >= self.max_batch:
+                self.open = None   # закрыта: следующий откроет новую
+                batch.full.set()
+
+        try:
+            if leader:
+                batch.full.wait(self.window)
+                with self.lock:
+                    if self.open is batch:
+                        self.open = None
+                self.flush(batch)
+            return future.result()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def flush(self, batch: _Batch):
+        now    = time.monotonic()
+        unique = list(dict.fromkeys(batch.texts))   # одинаковые запросы — один раз
+        with self.lock:
+            self.batches += 1
+            self.texts   += len(unique)
+            self.sizes.append(len(batch.waiters))
+            self.waits.extend(now - queued for _, _, queued in batch.waiters)
+        try:
+            by_text = dict(zip(unique, self.embed_fn(unique)))
+        except Exception as e:
+            for future, _, _ in batch.waiters:
+                future.set_exception(e)
+            return
+        for future, part, _ in batch.waiters:
+            future.set_result([by_text[t] for t in batch.texts[part]])
+
+    def stats(self) -> dict:
+        with self.lock:
+            sizes = sorted(self.sizes)
+            waits = sorted(self.waits)
+        pick = lambda values, q: values[min(len(values) - 1, int(q * len(values)))] if values else None
+        ms   = lambda v: round(v * 1000, 2) if v is not None else None
+        return {
+            "window_ms":       ms(self.window),
+            "max_batch":       self.max_batch,
+            "calls":           self.calls,
+            "requests":        self.batches,
+            "immediate":       self.immediate,
+            "texts":           self.texts,
+            "calls_per_batch": round(sum(sizes) / len(sizes), 2) if sizes else None,
+            "batch_max":       sizes[-1] if sizes else None,
+            "wait_p50_ms":     ms(pick(waits, 0.5)),
+            "wait_p95_ms":     ms(pick(waits, 0.95)),
+        }
+
+
+_batcher = None
+
+
+def get_batcher() -> QueryBatcher:
+    global _batcher
+    with _init_lock:
+        if _batcher is None:
+            embedder = get_embedder()
+            _batcher = QueryBatcher(lambda texts: embedder.embed(texts, query=True))
+        return _batcher
+
+
+def embed_queries(queries: list[str]) -> list[list[float]]:
+    """Векторы запросов: найденные в кэше — из кэша, остальные — одним запросом к эмбеддеру."""
+    embedder = get_embedder()
+    cache    = get_query_cache()
+    model    = embedder.cache_key(query=True)
+    vectors  = [cache.get(model, embedder.dimensions, q) if cache is not None else None
+                for q in queries]
+    missing  = list(dict.fromkeys(q for q, v in zip(queries, vectors) if v is None))
+    if missing:
+        fresh = dict(zip(missing, get_batcher().embed(missing)))
+        for q in missing:
+            if cache is not None:
+                cache.put(model, embedder.dimensions, q, fresh[q])
+        vectors = [v if v is not None else fresh[q] for q, v in zip(queries, vectors)]
+    return vectors
+
+
+def embed_query(query: str) -> list[float]:
+    return embed_queries([query])[0]
+
+
+_lexical = None
+
+
+def get_lexical() -> LexicalIndex | None:
+    """Лексический индекс коллекции; None — indexer.py его ещё не построил."""
+    global _lexical
+    with _init_lock:
+        if _lexical is None:
+            path = lexical.index_path(collection_name())
+            if not path.exists():
+                return None
+            _lexical = LexicalIndex(path)
+        return _lexical
+
+
+def query_collection(**kwargs) -> dict:
+    """collection.query на тёплой коллекции; если её пересоздали — переоткрываем."""
+    try:
+        return get_collection().query(**kwargs)
+    except NotFoundError:
+        return get_collection(reopen=True).query(**kwargs)
+
+
+def get_chunks(ids: list[str]) -> dict[str, tuple[str, dict]]:
+    """{id: (документ, метаданные)} — для чанков, найденных только лексически."""
+    if not ids:
+        return {}
+    try:
+        res = get_collection().get(ids=ids, include=["documents", "metadatas"])
+    except NotFoundError:
+        res = get_collection(reopen=True).get(ids=ids, include=["documents", "metadatas"])
+    return {i: (doc or "", meta or {}) for i, doc, meta in zip(res["ids"], res["documents"], res["metadatas"])}
+
+
+def vector_search(requests: list[tuple[str, int, dict | None]]) -> list[list[tuple]]:
+    """
+    requests — [(запрос, k, where)] → для каждого [(id, косинусная близость,
+    документ, метаданные)]. Все запросы эмбеддятся одним вызовом; where у
+    collection.query общий, поэтому один многовекторный query на каждый where.
+    """
+    vectors = embed_queries([q for q, _, _ in requests])
+    groups: dict[str, list[int]] = {}
+    for i, (_, _, where) in enumerate(requests):
+        groups.setdefault(json.dumps(where, sort_keys=True, ensure_ascii=False), []).append(i)
+
+    found: list[list[tuple]] = [[] for _ in requests]
+    for idx in groups.values():
+        results = query_collection(
+            query_embeddings=[vectors[i] for i in idx],
+            n_results=max(requests[i][1] for i in idx),
+            where=requests[idx[0]][2],
+            include=["documents", "metadatas", "distances"],
+        )
+        for row, i in enumerate(idx):
+            k = requests[i][1]
+            found[i] = list(zip(
+                results["ids"][row][:k],
+                [1 - d for d in results["distances"][row][:k]],
+                results["documents"][row][:k],
+                results["metadatas"][row][:k],
+            ))
+    return found
+
+
+def lexical_search(query: str, k: int, source: str | None,
+                   where: dict | None = None) -> list[tuple[str, float]]:
+    """
+    BM25 по индексу; source фильтруется в нём самом. Прочие условия where
+    (даты, автор, теги) — в метаданных Chroma: кандидатов берётся с запасом
+    и оставляются те, что проходят тот же where.
+    """
+    index = get_lexical()
+    if index is None:
+        return []
+    if where is None or where == {"source": source}:
+        return index.search(query, k, source)
+    hits = index.search(query, k * FILTER_OVERFETCH, source)
+    if not hits:
+        return []
+    kwargs = dict(ids=[i for i, _ in hits], where=where, include=[])
+    try:
+        allowed = set(get_collection().get(**kwargs)["ids"])
+    except NotFoundError:
+        allowed = set(get_collection(reopen=True).get(**kwargs)["ids"])
+    return [h for h in hits if h[0] in allowed][:k]
 
-    response = oai.embeddings.create(
-        model="text-embedding-3-large",
-        input=[query],
-    )
-    vector = response.data[0].embedding
-
-    collection = get_collection()
-    where = {"source": source} if source else None
-    results    = collection.query(
-        query_embeddings=[vector],
-        n_results=n,
-        where=where,
-        include=["documents", "metadatas", "distances"],
-    )
 
-    hits = []
-    for doc, meta, dist in zip(
-        results["documents"][0],
-        results["metadatas"][0],
-        results["distances"][0],
-    ):
-        hits.append({
-            "score":   round(1 - dist, 3),
-            "id":      meta.get("id", ""),
-            "title":   meta.get("title", ""),
-            "section": meta.get("section", ""),
-            "excerpt": doc[:300],
+def search_many(requests: list[dict], mode: str = "hybrid", group_by: str = "chunk",
+                aggregate: str = "max", full_text: bool = False) -> list[list[dict]]:
+    """
+    requests — [{"query", "n", "source", "date_from", "date_to", "author", "tags"}];
+    выдача для каждого, в том же порядке.
+    mode: hybrid — RRF векторной и лексической выдачи, vector, lexical.
+    В hybrid при недоступных эмбеддингах — только лексика (match = lexical),
+    и ещё EMBED_COOLDOWN секунд после сбоя эмбеддер не вызывается.
+    score — косинусная близость (vector), BM25 (lexical) или вес RRF (hybrid).
+    group_by=document — n документов вместо n чанков, см. group_documents.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Неизвестный режим поиска: {mode}")
+    if group_by not in ("chunk", "document"):
+        raise ValueError(f"Неизвестная группировка: {group_by}")
+    if aggregate not in AGGREGATES:
+        raise ValueError(f"Неизвестная агрегация: {aggregate}")
+    specs = [(r["query"], r.get("n", 5) * (DOC_OVERFETCH if group_by == "document" else 1),
+              r.get("source"), filters.build_where(r.get("source"), **{k: r.get(k) for k in FILTER_KEYS}))
+             for r in requests]
+    depth = [max(n * FUSION_DEPTH, 20) if mode == "hybrid" else n for _, n, _, _ in specs]
+
+    vector = [[] for _ in specs]
+    if mode == "hybrid" and embeddings_down() and get_lexical() is not None:
+        mode = "lexical"   # эмбеддер недавно упал — не ждём его снова
+    if mode != "lexical":
+        try:
+            vector = vector_search([(q, k, where) for (q, _, _, where), k in zip(specs, depth)])
+            mark_embeddings(True)
+        except (OSError, openai.APIError) as e:
+            mark_embeddings(False)
+            if mode == "vector" or get_lexical() is None:
+                raise
+            print(f"Эмбеддинги недоступны ({type(e).__name__}: {e}), поиск только лексический"
+                  f" ({EMBED_COOLDOWN:g} с без попыток)", file=sys.stderr)
+            mode = "lexical"
+
+    ranked, matches, found = [], [], {}
+    for (query, n, source, where), k, vec in zip(specs, depth, vector):
+        lex = lexical_search(query, k, source, where) if mode != "vector" else []
+        if mode == "vector":
+            ranked.append([(i, score) for i, score, _, _ in vec])
+        elif mode == "lexical":
+            ranked.append(lex[:n])
+        else:
+            ranked.append(lexical.rrf([h[0] for h in vec], [h[0] for h in lex])[:n])
+        matches.append(({h[0] for h in vec}, {h[0] for h in lex}))
+        found.update({i: (doc, meta) for i, _, doc, meta in vec})
+    # найденные только лексически — одним get на все запросы
+    found |= get_chunks(list(dict.fromkeys(i for r in ranked for i, _ in r if i not in found)))
+
+    grouped = []
+    for r, (in_vec, in_lex) in zip(ranked, matches):
+        hits = []
+        for chunk_id, score in r:
+            if chunk_id not in found:   # лексический индекс отстал от коллекции
+                continue
+            doc, meta = found[chunk_id]
+            hits.append({
+                "score":   round(score, 4 if mode == "hybrid" else 3),
+                "match":   "both" if chunk_id in in_vec and chunk_id in in_lex
+                           else "vector" if chunk_id in in_vec else "lexical",
+                "id":      chunk_id,
+                "doc":     chunk_id.split("__c")[0],
+                "title":   meta.get("title", ""),
+                "section": meta.get("section", ""),
+                "excerpt": doc[:300],
+            })
+        grouped.append(hits)
+
+    if group_by == "document":
+        grouped = [group_documents(hits, r.get("n", 5), aggregate)
+                   for r, hits in zip(requests, grouped)]
+        if full_text:
+            load_full_texts([d for docs in grouped for d in docs])
+    return grouped
+
+
+def group_documents(hits: list[dict], n: int, aggregate: str = "max") -> list[dict]:
+    """
+    Чанки одного документа (doc__c0…__cN) → один результат. Оценка — агрегат
+    оценок его найденных чанков; chunks — лучшие DOC_CHUNKS по рангу.
+    """
+    by_doc: dict[str, list[dict]] = {}
+    for h in hits:   # hits уже по убыванию — первый чанк документа лучший
+        by_doc.setdefault(h["doc"], []).append(h)
+    docs = []
+    for doc_id, chunks in by_doc.items():
+        matches = {c["match"] for c in chunks}
+        docs.append({
+            "score":   round(AGGREGATES[aggregate]([c["score"] for c in chunks]), 4),
+            "match":   matches.pop() if len(matches) == 1 else "both",
+            "id":      doc_id,
+            "title":   chunks[0]["title"],
+            "section": chunks[0]["section"],
+            "matched": len(chunks),
+            "chunks":  chunks[:DOC_CHUNKS],
         })
-    return hits
+    docs.sort(key=lambda d: -d["score"])
+    return docs[:n]
+
+
+# ── Полные тексты документов ──────────────────────────────────────────────────
+
+_doc_paths = None
+_doc_stamp = None
+
+
+def doc_paths() -> dict[str, Path]:
+    """
+    {id документа: файл} из манифеста; перечитывается, когда манифест
+    изменился. corpus-annotations.md (много записей в одном файле) не входит —
+    у записи корпуса полный текст и есть её единственный чанк.
+    """
+    global _doc_paths, _doc_stamp
+    path = layout.manifest_file(collection_name())
+    try:
+        stamp = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _init_lock:
+        if stamp != _doc_stamp:
+            _, manifest = read_manifest(path)
+            _doc_paths  = {
+                i.split("__c")[0]: REPO_ROOT / key
+                for key, entry in manifest.items() if "entries" not in entry
+                for i in entry.get("ids", [])
+            }
+            _doc_stamp = stamp
+        return _doc_paths
+
+
+def load_full_texts(docs: list[dict]):
+    """Дописывает text в документы выдачи — читаются только их файлы."""
+    paths = doc_paths()
+    for d in docs:
+        path = paths.get(d["id"])
+        try:
+            text = path.read_text(encoding="utf-8") if path is not None else None
+        except OSError:
+            text = None
+        if text is None:   # файла нет (корпус, удалён) — склеиваем найденные чанки
+            text = "\n\n".join(c["excerpt"] for c in d["chunks"])
+        d["text"] = text[:DOC_TEXT_MAX]
+
+
+def search_corpus(query: str, n: int = 5, source: str | None = None,
+                  mode: str = "hybrid", where_args: dict | None = None, **grouping) -> list[dict]:
+    """where_args — date_from, date_to, author, tags; grouping — group_by, aggregate, full_text."""
+    request = {"query": query, "n": n, "source": source, **(where_args or {})}
+    return search_many([request], mode, **grouping)[0]
+
+
+def search_corpus_batch(queries: list[dict], mode: str = "hybrid", **grouping) -> list[list[dict]]:
+    """Несколько запросов за один вызов эмбеддингов; не больше BATCH_MAX_QUERIES."""
+    if not queries:
+        return []
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise ValueError(f"Не больше {BATCH_MAX_QUERIES} запросов за раз, получено {len(queries)}")
+    return search_many(queries, mode, **grouping)
+
+
+def diagnostics() -> dict:
+    """Состояние сервера: эмбеддер, коллекция, кэш запросов."""
+    cache = get_query_cache()
+    return {
+        "uptime_s":    round(time.time() - STARTED, 1),
+        "embedder":    EMBEDDER_SPEC,
+        "collection":  _collection.name if _collection is not None else None,
+        "lexical":     get_lexical().count() if get_lexical() is not None else None,
+        "dispatcher":  DISPATCHER.stats() if DISPATCHER is not None else None,
+        "embed_batch": _batcher.stats() if _batcher is not None else None,
+        "embed_down":  {
+            "failures":    _embed_failures,
+            "cooldown_s":  round(max(0.0, _embed_down_until - time.monotonic()), 1),
+        },
+        "query_cache": cache.stats() if cache is not None else None,
+    }
 
 
 # ── MCP protocol (stdio) ──────────────────────────────────────────────────────
 
+FILTER_SCHEMA = {
+    "date_from": {
+        "type":        "string",
+        "description": (
+            "Не раньше даты: ГГГГ, ГГГГ-ММ или ГГГГ-ММ-ДД (ЖЖ, Telegram, дневники, "
+            "стихи — по строке «Год:»). Документы без разбираемой даты отбрасываются."
+        ),
+    },
+    "date_to": {
+        "type":        "string",
+        "description": "Не позже, период включительно: «2010» — по 31.12.2010.",
+    },
+    "author": {
+        "type":        "string",
+        "description": "Автор стихотворения, точное совпадение.",
+    },
+    "tags": {
+        "type":        "array",
+        "items":       {"type": "string"},
+        "description": "Теги ЖЖ — хотя бы один из списка, без учёта регистра.",
+    },
+}
+
+SOURCE_SCHEMA = {
+    "type":        "string",
+    "description": (
+        "Фильтр источника: "
+        + ", ".join(f"'{name}' ({title})" for name, title in SOURCE_TITLES.items())
+        + ". Без этого параметра — все источники."
+    ),
+    "enum":        list(SOURCE_TITLES),   # тот же список, что индексирует indexer.py
+}
+
+GROUPING_SCHEMA = {
+    "group_by": {
+        "type":        "string",
+        "description": (
+            "chunk (по умолчанию) — отдельные фрагменты; document — n разных документов: "
+            "фрагменты одного длинного поста схлопываются, у каждого — лучшие совпадения."
+        ),
+        "enum":        ["chunk", "document"],
+        "default":     "chunk",
+    },
+    "aggregate": {
+        "type":        "string",
+        "description": (
+            "Оценка документа при group_by=document: max — лучший фрагмент, "
+            "sum — учитывает, сколько фрагментов совпало, mean — среднее."
+        ),
+        "enum":        list(AGGREGATES),
+        "default":     "max",
+    },
+    "full_text": {
+        "type":        "boolean",
+        "description": f"При group_by=document приложить полный текст (до {DOC_TEXT_MAX} символов) найденных документов.",
+        "default":     False,
+    },
+}
+
 TOOLS = [
     {
         "name":        "search_corpus",
@@ -77,8 +791,9 @@ TOOLS = [
             "Семантический поиск по корпусу текстов Клоди Спарк. "
             "Возвращает наиболее близкие по смыслу тексты. "
             "Используй source='corpus' для поиска по собственным философским текстам, "
-            "source='lj' для ЖЖ-архива, source='poetry' для стихов. "
-            "Без source — поиск по всем источникам сразу."
+            "source='lj' для ЖЖ-архива, source='poetry' для стихов, 'telegram' — "
+            "для Telegram-канала, 'journal' и 'daughter_journal' — для дневников, "
+            "'texts' — для эссе. Без source — поиск по всем источникам сразу."
         ),
         "inputSchema": {
             "type": "object",
@@ -92,15 +807,62 @@ TOOLS = [
                     "description": "Количество результатов (по умолчанию 5)",
                     "default":     5,
                 },
-                "source": {
+                "source": SOURCE_SCHEMA,
+                "mode": {
                     "type":        "string",
-                    "description": "Фильтр источника: 'corpus', 'lj', 'poetry', 'telegram'. Без этого параметра — все источники.",
-                    "enum":        ["corpus", "lj", "poetry", "telegram"],
+                    "description": (
+                        "hybrid (по умолчанию) — смысл + точные слова; lexical — точные слова, "
+                        "имена, цитаты, теги; vector — только смысловая близость."
+                    ),
+                    "enum":        list(SEARCH_MODES),
+                    "default":     "hybrid",
                 },
+                **FILTER_SCHEMA,
+                **GROUPING_SCHEMA,
             },
             "required": ["query"],
         },
-    }
+    },
+    {
+        "name":        "search_corpus_batch",
+        "description": (
+            "Несколько поисков по корпусу за один вызов — дешевле и быстрее, чем "
+            "search_corpus подряд: все запросы эмбеддятся одним обращением к API. "
+            f"До {BATCH_MAX_QUERIES} запросов, у каждого свои n и source. "
+            "Результаты сгруппированы по запросам в том же порядке."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "queries": {
+                    "type":     "array",
+                    "maxItems": BATCH_MAX_QUERIES,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "query":  {"type": "string"},
+                            "n":      {"type": "integer", "default": 5},
+                            "source": SOURCE_SCHEMA,
+                            **FILTER_SCHEMA,
+                        },
+                        "required": ["query"],
+                    },
+                },
+                "mode": {
+                    "type":    "string",
+                    "enum":    list(SEARCH_MODES),
+                    "default": "hybrid",
+                },
+                **GROUPING_SCHEMA,
+            },
+            "required": ["queries"],
+        },
+    },
+    {
+        "name":        "diagnostics",
+        "description": "Состояние поискового сервера: эмбеддер, коллекция, доля попаданий в кэш запросов.",
+        "inputSchema": {"type": "object", "properties": {}},
+    },
 ]
 
 
@@ -110,6 +872,31 @@ def send(obj: dict):
     sys.stdout.flush()
 
 
+def format_hits(hits: list[dict]) -> str:
+    text = ""
+    for h in hits:
+        if "chunks" in h:   # group_by=document
+            text += f"[{h['score']}] {h['title']} ({h['section']}) [{h['match']}] {h['id']}, "
+            text += f"совпало фрагментов: {h['matched']}\n"
+            for c in h["chunks"]:
+                text += f"  · [{c['score']}] {c['excerpt']}\n"
+            if "text" in h:
+                text += f"  --- полный текст ---\n{h['text']}\n"
+            text += "\n"
+            continue
+        text += f"[{h['score']}] {h['title']} ({h['section']}) [{h['match']}]\n"
+        text += f"  {h['excerpt']}\n\n"
+    return text.strip()
+
+
+def grouping_args(args: dict) -> dict:
+    return {
+        "group_by":  args.get("group_by", "chunk"),
+        "aggregate": args.get("aggregate", "max"),
+        "full_text": bool(args.get("full_text", False)),
+    }
+
+
 def handle(request: dict) -> dict | None:
     method = request.get("method")
     rid    = request.get("id")
@@ -131,21 +918,37 @@ def handle(request: dict) -> dict | None:
         name   = request["params"]["name"]
         args   = request["params"].get("arguments", {})
         if name == "search_corpus":
-            hits = search_corpus(args["query"], args.get("n", 5), args.get("source"))
-            text = ""
-            for h in hits:
-                text += f"[{h['score']}] {h['title']} ({h['section']})\n"
-                text += f"  {h['excerpt']}\n\n"
+            hits = search_corpus(args["query"], args.get("n", 5), args.get("source"),
+                                 args.get("mode", "hybrid"),
+                                 {k: args[k] for k in FILTER_KEYS if k in args},
+                                 **grouping_args(args))
+            return {
+                "jsonrpc": "2.0", "id": rid,
+                "result":  {"content": [{"type": "text", "text": format_hits(hits)}]},
+            }
+        if name == "search_corpus_batch":
+            queries = args["queries"]
+            groups  = search_corpus_batch(queries, args.get("mode", "hybrid"), **grouping_args(args))
+            text    = "\n\n".join(
+                f"## «{q['query']}»\n" + (format_hits(hits) or "(ничего не найдено)")
+                for q, hits in zip(queries, groups)
+            )
+            return {
+                "jsonrpc": "2.0", "id": rid,
+                "result":  {"content": [{"type": "text", "text": text}]},
+            }
+        if name == "diagnostics":
+            text = json.dumps(diagnostics(), ensure_ascii=False, indent=2)
             return {
                 "jsonrpc": "2.0", "id": rid,
-                "result":  {"content": [{"type": "text", "text": text.strip()}]},
+                "result":  {"content": [{"type": "text", "text": text}]},
             }
         return {
             "jsonrpc": "2.0", "id": rid,
             "error":   {"code": -32601, "message": f"Unknown tool: {name}"},
         }
 
-    if method == "notifications/initialized":
+    if (method or "").startswith("notifications/"):
         return None  # уведомление, ответ не нужен
 
     return {
@@ -154,19 +957,135 @@ def handle(request: dict) -> dict | None:
     }
 
 
-def main():
-    for raw_line in sys.stdin:
-        raw_line = raw_line.strip()
-        if not raw_line:
-            continue
+def error_response(rid, code: int, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": rid, "error": {"code": code, "message": message}}
+
+
+# ── Диспетчер ─────────────────────────────────────────────────────────────────
+
+class Dispatcher:
+    """
+    Читает запросы в цикле asyncio. tools/call выполняются в пуле потоков
+    (не больше workers одновременно, остальные ждут в очереди пула), всё
+    прочее — сразу, так что tools/list не стоит за медленным поиском.
+    Ответы идут в одну очередь, из которой пишет единственный writer:
+    строки в stdout не перемешиваются, порядок — по готовности, id — исходные.
+
+    notifications/cancelled: ожидающий в пуле запрос не запустится, уже
+    выполняемый доработает в своём потоке, но ответа на него не будет.
+    """
+
+    def __init__(self, workers: int = MCP_WORKERS):
+        self.workers   = max(1, workers)
+        self.pool      = ThreadPoolExecutor(self.workers, thread_name_prefix="mcp")
+        self.out       = asyncio.Queue()
+        self.inflight: dict = {}   # id запроса → asyncio.Task
+        self.tasks:    set  = set()  # все tools/call в работе, в т.ч. без id
+        self.completed = 0
+        self.cancelled = 0
+
+    async def writer(self):
+        while True:
+            obj = await self.out.get()
+            if obj is None:
+                return
+            send(obj)
+
+    async def call(self, request: dict):
+        rid = request.get("id")
+        try:
+            response = await asyncio.wrap_future(self.pool.submit(handle, request))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            return
+        except Exception as e:
+            response = error_response(rid, -32603, str(e))
+        finally:
+            if self.inflight.get(rid) is asyncio.current_task():
+                del self.inflight[rid]
+        self.completed += 1
+        if response is not None and "id" in request:   # уведомлению (без id) ответ не положен
+            self.out.put_nowait(response)
+
+    def dispatch(self, raw: str):
+        """Одна строка stdin. Любая ошибка — ответ с кодом, но не выход из цикла."""
+        try:
+            self._dispatch(raw)
+        except Exception as e:
+            self.out.put_nowait(error_response(None, -32603, f"Internal error: {e}"))
+
+    def _dispatch(self, raw: str):
+        try:
+            request = json.loads(raw)
+        except json.JSONDecodeError as e:
+            self.out.put_nowait(error_response(None, -32700, f"Parse error: {e}"))
+            return
+        if not isinstance(request, dict):
+            self.out.put_nowait(error_response(None, -32600, "Invalid Request: ожидается объект"))
+            return
+        # id по JSON-RPC — строка, число или null; прочее не годится и в ключ inflight
+        if not isinstance(request.get("id"), (str, int, float, type(None))):
+            self.out.put_nowait(error_response(None, -32600, "Invalid Request: недопустимый id"))
+            return
+        method = request.get("method")
+
+        if method == "notifications/cancelled":
+            params = request.get("params")
+            target = params.get("requestId") if isinstance(params, dict) else None
+            task   = self.inflight.get(target) if isinstance(target, (str, int, float)) else None
+            if task is not None:
+                task.cancel()
+            return
+        if method == "tools/call":
+            # и без id (уведомление) — в пул: поиск не должен стоять в цикле
+            task = asyncio.create_task(self.call(request))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            if "id" in request:
+                self.inflight[request["id"]] = task
+            return
+
         try:
-            request  = json.loads(raw_line)
             response = handle(request)
-            if response is not None:
-                send(response)
         except Exception as e:
-            send({"jsonrpc": "2.0", "id": None,
-                  "error": {"code": -32603, "message": str(e)}})
+            response = error_response(request.get("id"), -32603, str(e))
+        if response is not None and "id" in request:
+            self.out.put_nowait(response)
+
+    async def serve(self, stream=None):
+        stream = stream or sys.stdin
+        loop   = asyncio.get_running_loop()
+        writer = asyncio.create_task(self.writer())
+        # чтение stdin блокирующее — в своём потоке, цикл остаётся свободным
+        with ThreadPoolExecutor(1, thread_name_prefix="stdin") as reader:
+            while True:
+                line = await loop.run_in_executor(reader, stream.readline)
+                if not line:
+                    break
+                if line.strip():
+                    self.dispatch(line.strip())
+        # EOF: дописываем ответы на уже принятые запросы
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.out.put_nowait(None)
+        await writer
+        self.pool.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            "workers":   self.workers,
+            "inflight":  len(self.inflight),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+        }
+
+
+DISPATCHER: Dispatcher | None = None
+
+
+def main():
+    global DISPATCHER
+    DISPATCHER = Dispatcher(MCP_WORKERS)
+    asyncio.run(DISPATCHER.serve())
 
 
 if __name__ == "__main__":